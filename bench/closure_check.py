@@ -0,0 +1,130 @@
+# Copyright (c) 2021 Linux Foundation
+# Licensed under the Apache License, Version 2.0
+# pylint: disable=E0401
+# pyright: reportMissingImports=false
+
+"""
+Checks that the dm.dm_domain_closure trigger keeps the closure table equal to a full recomputation.
+
+Installs sql/dm_domain_closure.sql, applies random inserts, moves, retirements and deletes to a private range
+of domain ids above the existing ones, and compares the trigger-maintained rows with a recursive walk after every
+step, then checks dm.dm_domain_closure_rebuild() against the whole table. Everything runs in one transaction
+that is rolled back, so the database is left as it was.
+"""
+
+import argparse
+import os
+import random
+import sys
+from pathlib import Path
+
+import psycopg2
+
+# Same walk as dm.dm_domain_closure_rebuild(), limited to the domains this script created
+EXPECTED_SQL = """
+WITH RECURSIVE walk (ancestor, descendant, depth) AS (
+    SELECT id, id, 0 FROM dm.dm_domain WHERE status = 'N' AND id >= %(first)s
+    UNION ALL
+    SELECT w.ancestor, d.id, w.depth + 1
+    FROM walk w
+        INNER JOIN dm.dm_domain d ON d.domainid = w.descendant AND d.status = 'N'
+    WHERE d.id <> w.ancestor
+)
+SELECT ancestor, descendant, depth FROM walk
+"""
+
+# The script's domains only ever hang below each other, so their closure rows all have one of them as ancestor
+ACTUAL_SQL = "SELECT ancestor, descendant, depth FROM dm.dm_domain_closure WHERE ancestor >= %(first)s"
+
+IS_ANCESTOR_SQL = """
+WITH RECURSIVE up (id) AS (
+    SELECT %(parent)s
+    UNION
+    SELECT d.domainid FROM dm.dm_domain d INNER JOIN up ON d.id = up.id WHERE d.domainid IS NOT NULL
+)
+SELECT %(child)s IN (SELECT id FROM up)
+"""
+
+
+def random_step(cursor, ids: list[int], next_id: int) -> int:
+    """
+    Applies one random change to the script's domains and returns the next unused id.
+    """
+    choice = random.random()
+    if choice < 0.4 or len(ids) < 5:
+        parent = random.choice(ids) if ids and random.random() < 0.9 else None
+        cursor.execute(
+            "INSERT INTO dm.dm_domain (id, name, domainid, status) VALUES (%s, %s, %s, %s)",
+            (next_id, f"closure{next_id}", parent, "N" if random.random() < 0.9 else "Y"),
+        )
+        ids.append(next_id)
+        return next_id + 1
+    if choice < 0.6:
+        cursor.execute("UPDATE dm.dm_domain SET status = CASE WHEN status = 'N' THEN 'Y' ELSE 'N' END WHERE id = %s", (random.choice(ids),))
+    elif choice < 0.8:
+        child, parent = random.choice(ids), random.choice(ids)
+        # dm.dm_domain never holds a cycle, so moves under the domain's own subtree are skipped
+        cursor.execute(IS_ANCESTOR_SQL, {"child": child, "parent": parent})
+        if not cursor.fetchone()[0]:
+            cursor.execute("UPDATE dm.dm_domain SET domainid = %s WHERE id = %s", (parent, child))
+    elif choice < 0.9:
+        victim = random.choice(ids)
+        cursor.execute("DELETE FROM dm.dm_domain WHERE id = %s", (victim,))
+        ids.remove(victim)
+    else:
+        # Multi-row statements fire the trigger once per row in an unspecified order
+        cursor.execute("UPDATE dm.dm_domain SET status = CASE WHEN status = 'N' THEN 'Y' ELSE 'N' END WHERE id = ANY(%s)", (random.sample(ids, 3),))
+    return next_id
+
+
+def closure_rows(cursor, sql: str, first: int) -> set[tuple[int, int, int]]:
+    cursor.execute(sql, {"first": first})
+    return set(cursor.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=1500, help="number of random domain changes to apply")
+    parser.add_argument("--seed", type=int, default=42, help="random seed so runs are reproducible")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    script = (Path(__file__).parent.parent / "sql" / "dm_domain_closure.sql").read_text().replace("{channel}", "")
+
+    conn = psycopg2.connect(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+        dbname=os.getenv("DB_NAME", "postgres"),
+        user=os.getenv("DB_USER", "postgres"),
+        password=os.getenv("DB_PASS", "postgres"),
+    )
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(script)
+            cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM dm.dm_domain")
+            first = cursor.fetchone()[0]
+
+            ids: list[int] = []
+            next_id = first
+            for step in range(args.steps):
+                next_id = random_step(cursor, ids, next_id)
+                expected = closure_rows(cursor, EXPECTED_SQL, first)
+                actual = closure_rows(cursor, ACTUAL_SQL, first)
+                if actual != expected:
+                    sys.exit(f"Step {step}: closure differs from a full walk, e.g. {sorted(actual ^ expected)[:10]}")
+
+            cursor.execute("SELECT ancestor, descendant, depth FROM dm.dm_domain_closure")
+            maintained = set(cursor.fetchall())
+            cursor.execute("SELECT dm.dm_domain_closure_rebuild()")
+            cursor.execute("SELECT ancestor, descendant, depth FROM dm.dm_domain_closure")
+            if set(cursor.fetchall()) != maintained:
+                sys.exit("The maintained closure table differs from dm.dm_domain_closure_rebuild()")
+    finally:
+        conn.rollback()
+        conn.close()
+
+    print(f"Closure matched a full walk after each of {args.steps} steps ({len(ids)} domains left, {len(expected)} closure rows)")
+
+
+if __name__ == "__main__":
+    main()
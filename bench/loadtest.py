@@ -0,0 +1,111 @@
+# Copyright (c) 2021 Linux Foundation
+# Licensed under the Apache License, Version 2.0
+# pylint: disable=E0401
+# pyright: reportMissingImports=false
+
+"""
+Drives /msapi/validateuser at a fixed concurrency and reports throughput and latency as JSON.
+
+Each result is one JSON object per line so runs from different commits can be compared directly.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+import httpx
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+async def worker(client: httpx.AsyncClient, url: str, tokens: list[str], offset: int, deadline: float, latencies: list[float], errors: list[int]):
+    pos = offset
+    while time.perf_counter() < deadline:
+        token = tokens[pos % len(tokens)]
+        pos += 1
+        start = time.perf_counter()
+        try:
+            response = await client.get(url, cookies={"token": token})
+            if response.status_code != 200:
+                errors[0] += 1
+        except httpx.HTTPError:
+            errors[0] += 1
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(base_url: str, tokens: list[str], concurrency: int, duration: float, domains: str, warmup: float) -> dict:
+    url = f"{base_url.rstrip('/')}/msapi/validateuser"
+    if domains:
+        url += f"?domains={domains}"
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        if warmup > 0:
+            await asyncio.gather(*(worker(client, url, tokens, i, time.perf_counter() + warmup, [], [0]) for i in range(concurrency)))
+
+        latencies: list[float] = []
+        errors = [0]
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(worker(client, url, tokens, i * 7919, deadline, latencies, errors) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "url": url,
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="base url of the running service")
+    parser.add_argument("--tokens", default=str(Path(__file__).parent / "out" / "tokens.txt"), help="file with one login token per line")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64], help="concurrency levels to run")
+    parser.add_argument("--domains", choices=["", "y", "n"], nargs="+", default=["", "y"], help="domains query values to run ('' omits it)")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to measure each run")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of unmeasured load before each run")
+    parser.add_argument("--output", help="append results to this file instead of stdout")
+    args = parser.parse_args()
+
+    tokens = [line.strip() for line in open(args.tokens) if line.strip()]
+    for domains in args.domains:
+        for concurrency in args.concurrency:
+            result = json.dumps(asyncio.run(run(args.url, tokens, concurrency, args.duration, domains, args.warmup)))
+            if args.output:
+                with open(args.output, "a") as output:
+                    output.write(result + "\n")
+            print(result, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+#!/bin/bash
+# Seeds a local Postgres, starts ms-validate-user against it and runs the load test matrix.
+# Database settings come from the usual DB_HOST/DB_PORT/DB_NAME/DB_USER/DB_PASS variables.
+# Extra arguments are passed through to loadtest.py, e.g. ./bench/run.sh --concurrency 32 --duration 60
+
+set -euo pipefail
+
+cd "$(dirname "$0")/.."
+OUT=bench/out
+PORT=${BENCH_PORT:-8089}
+
+python bench/seed.py --out "$OUT" ${SEED_ARGS:-}
+
+RSA_FILE="$OUT/id_rsa.pub" uvicorn main:app --host 127.0.0.1 --port "$PORT" --no-access-log &
+pid=$!
+trap 'kill $pid' EXIT
+
+for _ in $(seq 1 50); do
+	curl -sf "http://127.0.0.1:$PORT/health" >/dev/null && break
+	sleep 0.2
+done
+
+python bench/loadtest.py --url "http://127.0.0.1:$PORT" --tokens "$OUT/tokens.txt" "$@"
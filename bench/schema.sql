@@ -0,0 +1,37 @@
+-- Copyright (c) 2021 Linux Foundation
+-- Licensed under the Apache License, Version 2.0
+--
+-- Minimal synthetic copy of the Ortelius dm schema used by ms-validate-user benchmarks.
+
+DROP SCHEMA IF EXISTS dm CASCADE;
+CREATE SCHEMA dm;
+
+CREATE TABLE dm.dm_domain (
+    id integer PRIMARY KEY,
+    name varchar(2048) NOT NULL,
+    domainid integer,
+    status char(1) NOT NULL DEFAULT 'N'
+);
+CREATE INDEX dm_domain_domainid ON dm.dm_domain (domainid);
+
+CREATE TABLE dm.dm_user (
+    id integer PRIMARY KEY,
+    name varchar(2048) NOT NULL,
+    email varchar(2048),
+    passhash varchar(2048),
+    domainid integer,
+    status char(1) NOT NULL DEFAULT 'N',
+    modified integer
+);
+
+CREATE TABLE dm.dm_user_auth (
+    id integer NOT NULL,
+    jti varchar(2048) NOT NULL,
+    lastseen timestamp NOT NULL
+);
+CREATE INDEX dm_user_auth_id_jti ON dm.dm_user_auth (id, jti);
+CREATE INDEX dm_user_auth_lastseen ON dm.dm_user_auth (lastseen);
+
+CREATE TABLE dm.dm_tableinfo (
+    bootstrap text
+);
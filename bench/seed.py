@@ -0,0 +1,105 @@
+# Copyright (c) 2021 Linux Foundation
+# Licensed under the Apache License, Version 2.0
+# pylint: disable=E0401
+# pyright: reportMissingImports=false
+
+"""
+Seeds a local Postgres with a synthetic dm schema for benchmarking ms-validate-user.
+
+Creates a domain forest with one wide tree and one deep chain, users homed across it,
+one live session per user, an RS256 key pair and a login token per session.
+"""
+
+import argparse
+import base64
+import os
+import random
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import jwt
+import psycopg2
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from psycopg2.extras import execute_values
+
+
+def build_domains(count: int, width: int, depth: int) -> list[tuple[int, Optional[int]]]:
+    """
+    Returns (id, domainid) rows: a tree of `count` domains with `width` children per node,
+    plus a separate chain `depth` levels deep hanging off the first root.
+    """
+    rows: list[tuple[int, Optional[int]]] = [(1, None)]
+    queue = [1]
+    next_id = 2
+    while next_id <= count and queue:
+        parent = queue.pop(0)
+        for _ in range(width):
+            if next_id > count:
+                break
+            rows.append((next_id, parent))
+            queue.append(next_id)
+            next_id += 1
+
+    parent = 1
+    for _ in range(depth):
+        rows.append((next_id, parent))
+        parent = next_id
+        next_id += 1
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--domains", type=int, default=5000, help="number of domains in the wide tree")
+    parser.add_argument("--width", type=int, default=8, help="children per domain in the wide tree")
+    parser.add_argument("--depth", type=int, default=200, help="length of the deep domain chain")
+    parser.add_argument("--users", type=int, default=2000, help="number of users, each with one session")
+    parser.add_argument("--out", default=str(Path(__file__).parent / "out"), help="directory for the key pair and tokens")
+    parser.add_argument("--seed", type=int, default=42, help="random seed so runs are reproducible")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_pem = private_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    (out / "id_rsa.pub").write_bytes(public_pem)
+
+    conn = psycopg2.connect(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+        dbname=os.getenv("DB_NAME", "postgres"),
+        user=os.getenv("DB_USER", "postgres"),
+        password=os.getenv("DB_PASS", "postgres"),
+    )
+    with conn, conn.cursor() as cursor:
+        cursor.execute((Path(__file__).parent / "schema.sql").read_text())
+
+        domains = build_domains(args.domains, args.width, args.depth)
+        execute_values(cursor, "INSERT INTO dm.dm_domain (id, name, domainid, status) VALUES %s", [(domid, f"domain{domid}", parent, "N") for domid, parent in domains])
+
+        # Home users at the root, in the middle of the wide tree and at the bottom of the deep chain
+        homes = [1, domains[len(domains) // 2][0], domains[-1][0]] + [domid for domid, _ in random.sample(domains, min(50, len(domains)))]
+        users = [(userid, f"user{userid}", f"user{userid}@example.com", random.choice(homes)) for userid in range(1, args.users + 1)]
+        execute_values(cursor, "INSERT INTO dm.dm_user (id, name, email, domainid, status) VALUES %s", [(u[0], u[1], u[2], u[3], "N") for u in users])
+
+        sessions = [(userid, str(uuid.uuid4())) for userid, _, _, _ in users]
+        execute_values(cursor, "INSERT INTO dm.dm_user_auth (id, jti, lastseen) VALUES %s", sessions, template="(%s, %s, current_timestamp at time zone 'UTC')")
+
+        cursor.execute("INSERT INTO dm.dm_tableinfo (bootstrap) VALUES (%s)", (base64.b64encode(public_pem).decode("ascii"),))
+    conn.close()
+
+    expires = int(time.time()) + 24 * 3600
+    with open(out / "tokens.txt", "w") as tokens:
+        for userid, jti in sessions:
+            tokens.write(jwt.encode({"sub": str(userid), "jti": jti, "exp": expires}, private_key, algorithm="RS256") + "\n")
+
+    print(f"Seeded {len(domains)} domains, {len(users)} users and sessions; keys and tokens in {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# Copyright (c) 2021 Linux Foundation
+# Licensed under the Apache License, Version 2.0
+
+# Multi-process launch: gunicorn -c gunicorn.conf.py main:app
+# DB_POOL_SIZE and DB_MAX_OVERFLOW apply per worker, so size them against WEB_CONCURRENCY.
+
+import glob
+import os
+import tempfile
+
+bind = os.getenv("BIND", "0.0.0.0:8080")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn_worker.UvicornWorker"
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+# Requests reach the service through the Ortelius gateway or an ingress. X-Forwarded-For is honoured from these
+# addresses or CIDR ranges so request.client (and the per-client recovery rate limit) is the real caller, not the proxy.
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1,::1")
+
+# Import the app once in the master so workers fork with it loaded. With more than one worker the session cache
+# defaults to a shared memory map so every worker sees the others' entries; a single worker keeps the in-process LRU.
+# No connections are opened at import time; each worker builds its own pools in the lifespan handler.
+preload_app = True
+if workers > 1:
+    os.environ.setdefault("SESSION_CACHE_SHARED", "y")
+
+# Each worker keeps its own Prometheus metrics. With more than one worker they are written to files in
+# PROMETHEUS_MULTIPROC_DIR and merged on scrape. This has to be set before the preloaded app imports prometheus_client.
+if workers > 1:
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "ms-validate-user-metrics"))
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Files left by a previous run would be merged into this one's counters
+    for stale in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(stale)
+
+
+def child_exit(server, worker):
+    # Drops the live gauges of a worker that exited; its counters stay in the totals
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
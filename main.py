@@ -3,23 +3,41 @@
 # pylint: disable=E0401
 # pyright: reportMissingImports=false
 
+import asyncio
+import atexit
 import base64
+import gzip
 import hashlib
+import json
 import logging
+import mmap
 import os
+import queue
+import random
 
 # Added for email sending
 import smtplib
 import ssl
-from datetime import datetime, timedelta
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import UTC, datetime, timedelta
 from email.message import EmailMessage
-from time import sleep
+from email.utils import formatdate, parsedate_to_datetime
+from functools import cache, partial
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional
+from uuid import uuid4
 
+import asyncpg
+import brotli
 import jwt
 import uvicorn
 from fastapi import (
-    BackgroundTasks,
     FastAPI,
     HTTPException,
     Query,
@@ -30,18 +48,158 @@ from fastapi import (
 
 # Import HTMLResponse to serve the HTML page
 from fastapi.responses import HTMLResponse
+from opentelemetry import trace
+from opentelemetry.propagate import extract
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from pydantic import BaseModel, EmailStr
-from sqlalchemy import create_engine, text
+from sqlalchemy import event, text
 from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.datastructures import Headers
+
+
+def env_flag(name: str, default: str) -> bool:
+    """
+    Reads a boolean setting; y, yes, true and 1 (in any case) turn it on.
+    """
+    return os.getenv(name, default).strip().lower() in ("y", "yes", "true", "1")
+
 
 # Init Globals
+imported_at = time.perf_counter()
 service_name = "ortelius-ms-validate-user"
-db_conn_retry = 3
-# Configure logging to show info-level messages
-logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+db_conn_retry = int(os.getenv("DB_CONN_RETRY", "3"))
+# Retries back off exponentially from DB_RETRY_BASE_DELAY up to DB_RETRY_MAX_DELAY seconds, with full jitter
+db_retry_base_delay = float(os.getenv("DB_RETRY_BASE_DELAY", "0.1"))
+db_retry_max_delay = float(os.getenv("DB_RETRY_MAX_DELAY", "2"))
+# After DB_BREAKER_THRESHOLD consecutive connection failures the database is skipped for DB_BREAKER_RESET seconds
+db_breaker_threshold = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+db_breaker_reset = float(os.getenv("DB_BREAKER_RESET", "10"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nothing is served until the pool, statements and caches are warm, so the first requests after a deploy are not slow
+    warmup_started = time.perf_counter()
+    login_help_page()
+    reset_password_page()
+    try:
+        await asyncio.wait_for(warm_up(), timeout=warmup_timeout)
+    except Exception as err:
+        logging.warning("Startup warm-up incomplete, continuing cold: %s", err or type(err).__name__)
+    ready_at = time.perf_counter()
+    STARTUP_DURATION.labels("warmup").set(ready_at - warmup_started)
+    STARTUP_DURATION.labels("import_to_ready").set(ready_at - imported_at)
+    logging.info("Ready %.2f seconds after import (warm-up %.2f seconds)", ready_at - imported_at, ready_at - warmup_started)
+
+    # Background maintenance runs beside the request handlers for the life of the process
+    tasks = []
+    tasks.append(asyncio.create_task(db_health_checker()))
+    mail_tasks = [asyncio.create_task(mail_worker()) for _ in range(max(mail_workers, 1))]
+    if session_purge_interval > 0:
+        tasks.append(asyncio.create_task(session_reaper()))
+    tasks.append(asyncio.create_task(lastseen_flusher()))
+    if metrics_multiprocess:
+        tasks.append(asyncio.create_task(metrics_publisher()))
+    tasks.append(asyncio.create_task(domain_index_refresher()))
+    if domain_closure_enabled:
+        tasks.append(asyncio.create_task(domain_closure_installer()))
+    if stateless_validation:
+        tasks.append(asyncio.create_task(revocation_syncer()))
+    if domain_notify_channel and not db_pgbouncer:
+        tasks.append(asyncio.create_task(domain_change_listener()))
+    yield
+    # Give queued emails a moment to go out before the workers stop
+    try:
+        await asyncio.wait_for(mail_queue.join(), timeout=5)
+    except TimeoutError:
+        logging.warning("Shutting down with %d unsent emails", mail_queue.qsize())
+    for task in tasks + mail_tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, *mail_tasks, return_exceptions=True)
+    # Write out any lastseen touches still buffered so active sessions are not purged after a restart
+    try:
+        await lastseen_buffer.flush()
+    except Exception as err:
+        logging.error("Final lastseen flush failed: %s", err)
+
 
 # Init FastAPI
-app = FastAPI(title=service_name, description=service_name)
+app = FastAPI(title=service_name, description=service_name, lifespan=lifespan)
+
+
+def route_path(scope: dict) -> str:
+    # Label by route template rather than raw path to keep metric cardinality bounded
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """
+    Records latency and status metrics, the access log entry and, when tracing, the server span of each HTTP request.
+    A plain ASGI middleware that only wraps send, so requests do not pay for BaseHTTPMiddleware's task group and stream.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        db_time = [0.0]
+        request_db_time.set(db_time)
+        # Reported when the app fails before starting a response
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        method = scope["method"]
+        try:
+            if tracer_provider is None:
+                await self.app(scope, receive, send_with_status)
+            else:
+                # Continue the gateway's trace when the request carries a traceparent header
+                with tracer.start_as_current_span(method, context=extract(Headers(scope=scope)), kind=SpanKind.SERVER) as span:
+                    try:
+                        await self.app(scope, receive, send_with_status)
+                    finally:
+                        if span.is_recording():
+                            path = route_path(scope)
+                            span.update_name(f"{method} {path}")
+                            span.set_attributes({"http.request.method": method, "http.route": path, "http.response.status_code": status_code})
+        finally:
+            latency = time.perf_counter() - start
+            path = route_path(scope)
+            REQUEST_LATENCY.labels(method, path).observe(latency)
+            REQUEST_COUNT.labels(method, path, str(status_code)).inc()
+            log_access(method, path, status_code, latency, db_time[0])
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    if not metrics_multiprocess:
+        return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    # Whichever worker answers merges the values every worker has written
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
 
 # --- Database Configuration ---
 db_host = os.getenv("DB_HOST", "localhost")
@@ -71,14 +229,327 @@ if smtp_port_env is None or smtp_port_env == "" or smtp_port_env == "<nil>":
 else:
     SMTP_PORT = int(smtp_port_env)
 
-public_key = ""
-if os.path.exists(id_rsa_pub):
-    public_key = open(id_rsa_pub, "r").read()
+# Outgoing mail is queued and sent by MAIL_WORKERS background workers, each holding one SMTP connection open.
+# Set SMTP_STARTTLS=n only for a local debugging server that does not speak TLS.
+SMTP_STARTTLS = env_flag("SMTP_STARTTLS", "y")
+smtp_timeout = float(os.getenv("SMTP_TIMEOUT", "30"))
+smtp_idle_timeout = float(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
+mail_workers = int(os.getenv("MAIL_WORKERS", "1"))
+mail_queue_size = int(os.getenv("MAIL_QUEUE_SIZE", "100"))
+mail_retries = int(os.getenv("MAIL_RETRIES", "3"))
+
+# --- Connection Pool Configuration ---
+# DB_PGBOUNCER=y makes the async engine safe behind PgBouncer transaction pooling: no server-side
+# prepared statements survive a transaction and the LISTEN connection for domain changes is not used.
+db_pool_size = int(os.getenv("DB_POOL_SIZE", "10"))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+db_pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+db_pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+db_pool_pre_ping = env_flag("DB_POOL_PRE_PING", "y")
+db_pgbouncer = env_flag("DB_PGBOUNCER", "n")
+
+pool_options = {
+    "pool_size": db_pool_size,
+    "max_overflow": db_max_overflow,
+    "pool_timeout": db_pool_timeout,
+    "pool_recycle": db_pool_recycle,
+    "pool_pre_ping": db_pool_pre_ping,
+}
+
+async_connect_args = {}
+if db_pgbouncer:
+    async_connect_args = {
+        "statement_cache_size": 0,
+        "prepared_statement_cache_size": 0,
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+    }
+
+# Async engine shared by every endpoint so database round-trips do not block the event loop
+async_engine = create_async_engine(
+    f"postgresql+asyncpg://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}",
+    connect_args=async_connect_args,
+    **pool_options,
+)
 
-engine = create_engine(
-    f"postgresql+psycopg2://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}",
-    pool_pre_ping=True,
+# --- Metrics ---
+# With more than one gunicorn worker, gunicorn.conf.py sets PROMETHEUS_MULTIPROC_DIR so every worker writes its
+# metrics to files there and a scrape of any worker returns the merged values.
+# Values computed at scrape time (caches, pools, queue depths) are copied to those files every METRICS_PUBLISH_INTERVAL seconds.
+metrics_multiprocess = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+metrics_publish_interval = float(os.getenv("METRICS_PUBLISH_INTERVAL", "5"))
+
+REQUEST_COUNT = Counter("http_requests_total", "HTTP requests handled", ["method", "route", "status"])
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+VALIDATE_STAGE_LATENCY = Histogram(
+    "validateuser_stage_duration_seconds",
+    "Time spent in each stage of user validation",
+    ["stage"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+DB_CHECKOUT_LATENCY = Histogram(
+    "db_pool_checkout_duration_seconds",
+    "Time spent waiting to check out a pooled database connection",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
 )
+DB_RETRIES = Counter("db_retries_total", "Database operations retried after a connection error")
+DB_BREAKER_REJECTS = Counter("db_circuit_breaker_rejections_total", "Database checkouts refused while the circuit breaker was open")
+EMAIL_SEND_LATENCY = Histogram("email_send_duration_seconds", "Time spent sending an email", ["result"], buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+RATE_LIMITED = Counter("rate_limited_total", "Requests rejected by a rate limiter", ["route", "limiter"])
+STARTUP_DURATION = Gauge("startup_duration_seconds", "Time taken by each startup phase", ["phase"], multiprocess_mode="liveall")
+VALIDATIONS_COALESCED = Counter("validations_coalesced_total", "Validations answered by joining an identical in-flight validation")
+REVOKED_SESSIONS = Gauge("revoked_sessions", "Revoked session ids held for stateless validation", multiprocess_mode="livemax")
+MAIL_QUEUE_DEPTH = Gauge("mail_queue_depth", "Emails waiting to be sent", multiprocess_mode="livesum")
+MAIL_DROPPED = Counter("mail_dropped_total", "Emails dropped because the mail queue was full or sending kept failing", ["reason"])
+
+# --- Tracing ---
+# TRACING_EXPORTER=otlp sends spans to the OTLP/HTTP collector named by OTEL_EXPORTER_OTLP_ENDPOINT (default
+# http://localhost:4318); TRACING_EXPORTER=file appends them to TRACING_FILE as JSON lines. Empty disables tracing.
+# TRACING_SAMPLE_RATE applies to traces started here; a traceparent from the gateway keeps its own sampling decision.
+tracing_exporter = os.getenv("TRACING_EXPORTER", "").lower()
+tracing_file = os.getenv("TRACING_FILE", "traces.jsonl")
+tracing_sample_rate = float(os.getenv("TRACING_SAMPLE_RATE", "0.01"))
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """
+    Appends finished spans to a file, one OpenTelemetry JSON span per line.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, spans) -> SpanExportResult:
+        for span in spans:
+            self._file.write(span.to_json(indent=None) + "\n")
+        self._file.flush()
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        self._file.close()
+
+
+def setup_tracing() -> Optional[TracerProvider]:
+    if tracing_exporter == "otlp":
+        # Imported here so the protobuf exporter is only loaded when it is used
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        exporter = OTLPSpanExporter()
+    elif tracing_exporter == "file":
+        exporter = JsonLinesSpanExporter(tracing_file)
+    else:
+        return None
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": service_name}),
+        sampler=ParentBased(TraceIdRatioBased(tracing_sample_rate)),
+    )
+    # Spans are exported from a background thread, so requests only pay for recording them
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    return provider
+
+
+tracer_provider = setup_tracing()
+tracer = tracer_provider.get_tracer(service_name) if tracer_provider else trace.NoOpTracer()
+
+
+def span_wanted() -> bool:
+    """
+    False when tracing is off or the current trace was not sampled, so unsampled requests create no spans at all.
+    """
+    if tracer_provider is None:
+        return False
+    parent = trace.get_current_span()
+    return parent.is_recording() or not parent.get_span_context().is_valid
+
+
+@contextmanager
+def traced_stage(stage: str):
+    """
+    Times a validation stage for the stage histogram and, in a sampled trace, as a child span.
+    """
+    with VALIDATE_STAGE_LATENCY.labels(stage).time():
+        if span_wanted():
+            with tracer.start_as_current_span(stage):
+                yield
+        else:
+            yield
+
+
+def start_statement_span(conn, cursor, statement, parameters, context, executemany):
+    span = None
+    if span_wanted():
+        span = tracer.start_span("db.statement", kind=SpanKind.CLIENT, attributes={"db.system": "postgresql", "db.statement": statement})
+    conn.info.setdefault("trace_spans", []).append(span)
+
+
+def end_statement_span(conn, cursor, statement, parameters, context, executemany):
+    span = conn.info["trace_spans"].pop()
+    if span is None:
+        return
+    if cursor.rowcount >= 0:
+        span.set_attribute("db.rowcount", cursor.rowcount)
+    span.end()
+
+
+def fail_statement_span(exception_context):
+    spans = exception_context.connection.info.get("trace_spans") if exception_context.connection else None
+    span = spans.pop() if spans else None
+    if span is not None:
+        span.set_status(Status(StatusCode.ERROR, str(exception_context.original_exception)))
+        span.end()
+
+
+if tracer_provider:
+    event.listen(async_engine.sync_engine, "before_cursor_execute", start_statement_span)
+    event.listen(async_engine.sync_engine, "after_cursor_execute", end_statement_span)
+    event.listen(async_engine.sync_engine, "handle_error", fail_statement_span)
+
+# asyncpg raises plain OSError subclasses (e.g. ConnectionRefusedError) when the server is unreachable
+db_retry_errors = (InterfaceError, OperationalError, OSError)
+
+
+class DatabaseUnavailable(Exception):
+    """
+    Raised instead of contacting the database while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Fails fast once the database has failed repeatedly, letting one probe through per reset interval.
+    A successful probe closes the breaker again.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # Re-arm before letting the probe through so concurrent callers keep failing fast
+            self.opened_at = now
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info("Database recovered, closing circuit breaker")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.error("Database failed %d times in a row, opening circuit breaker for %.1f seconds", self.failures, self.reset_timeout)
+            self.opened_at = time.monotonic()
+
+
+db_breaker = CircuitBreaker(db_breaker_threshold, db_breaker_reset)
+
+# --- Startup Warm-up ---
+# Before serving, WARMUP_CONNECTIONS pooled connections are opened and the hot statements prepared on each,
+# and the public key and domain index are loaded. Startup continues cold after WARMUP_TIMEOUT seconds.
+warmup_connections = min(int(os.getenv("WARMUP_CONNECTIONS", str(min(db_pool_size, 4)))), db_pool_size)
+warmup_timeout = float(os.getenv("WARMUP_TIMEOUT", "20"))
+
+# --- Session Validation Cache ---
+# Successful (userid, jti) validations are remembered for SESSION_CACHE_TTL seconds so repeat calls skip Postgres.
+# The TTL must stay well below the 1 hour lastseen expiry so active sessions still touch lastseen regularly.
+SESSION_CACHE_MAX_TTL = 900
+session_cache_size = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+session_cache_ttl = min(float(os.getenv("SESSION_CACHE_TTL", "60")), SESSION_CACHE_MAX_TTL)
+# With SESSION_CACHE_SHARED=y the cache lives in shared memory, so workers forked from a preloaded app share it.
+session_cache_shared = env_flag("SESSION_CACHE_SHARED", "n")
+
+# --- Rejected Token Cache ---
+# Digests of tokens that failed validation are remembered for REJECT_CACHE_TTL seconds and answered with 401
+# before any signature check or query. Keep the TTL short; a fresh login issues a new token and is never affected.
+reject_cache_size = int(os.getenv("REJECT_CACHE_SIZE", "10000"))
+reject_cache_ttl = float(os.getenv("REJECT_CACHE_TTL", "10"))
+
+# --- Expired Session Reaper ---
+# Validation rejects sessions idle for more than an hour; the reaper deletes their rows every SESSION_PURGE_INTERVAL
+# seconds (0 disables it). The Postgres advisory lock keeps replicas from purging at the same time.
+# Stateless validation only learns of idle sessions from those deletes, so it is not used while the reaper is off.
+session_purge_interval = float(os.getenv("SESSION_PURGE_INTERVAL", "60"))
+session_purge_lock_id = int(os.getenv("SESSION_PURGE_LOCK_ID", "72834001"))
+
+# --- Lastseen Write-Behind ---
+# Session lastseen touches are buffered and written in one batched UPDATE every LASTSEEN_FLUSH_MS milliseconds.
+lastseen_flush_ms = int(os.getenv("LASTSEEN_FLUSH_MS", "1000"))
+
+# --- Domain Hierarchy Index ---
+# The active dm.dm_domain tree is held in memory and reloaded every DOMAIN_INDEX_REFRESH seconds,
+# or as soon as a notification arrives on DOMAIN_NOTIFY_CHANNEL (empty disables LISTEN).
+# The domain closure trigger below sends these notifications; without it, have a trigger call pg_notify('<channel>', '').
+domain_index_refresh = float(os.getenv("DOMAIN_INDEX_REFRESH", "300"))
+domain_notify_channel = os.getenv("DOMAIN_NOTIFY_CHANNEL", "dm_domain_changed")
+# With DOMAIN_CLOSURE=y the service installs sql/dm_domain_closure.sql: a trigger-maintained closure table that
+# turns the fallback domain query into index lookups and notifies DOMAIN_NOTIFY_CHANNEL on every domain change.
+# It is off by default because it needs DDL rights in the dm schema and adds a trigger to the core dm.dm_domain table;
+# bench/closure_check.py verifies the trigger against a full recomputation.
+domain_closure_enabled = env_flag("DOMAIN_CLOSURE", "n")
+# Replicas take the SCHEMA_LOCK_ID advisory lock while installing the service-owned tables under sql/
+schema_lock_id = int(os.getenv("SCHEMA_LOCK_ID", "72834002"))
+
+# --- Stateless Validation ---
+# With STATELESS_VALIDATION=y a token with a valid signature is accepted without reading dm.dm_user_auth unless its jti
+# is in the revocation list, which is synced from dm.dm_user_auth_revoked every REVOCATION_SYNC_INTERVAL seconds.
+# A trigger records every deleted session there; rows are kept for REVOCATION_RETENTION seconds, so only tokens
+# whose exp - iat fits in that window are trusted this way. Other tokens, and all tokens while the last successful
+# sync is more than REVOCATION_MAX_STALENESS seconds old, are checked against the database as usual.
+stateless_validation = env_flag("STATELESS_VALIDATION", "n")
+revocation_sync_interval = float(os.getenv("REVOCATION_SYNC_INTERVAL", "5"))
+revocation_max_staleness = float(os.getenv("REVOCATION_MAX_STALENESS", "30"))
+revocation_retention = float(os.getenv("REVOCATION_RETENTION", "86400"))
+
+# --- Login Token Public Key ---
+# The parsed RS256 key is reused across requests. RSA_FILE is re-read when its mtime changes;
+# without RSA_FILE the bootstrap row in dm.dm_tableinfo is re-checked every KEY_REFRESH_INTERVAL seconds.
+key_refresh_interval = float(os.getenv("KEY_REFRESH_INTERVAL", "60"))
+
+# --- Batch Validation ---
+# Upper bound on the number of tokens accepted by one /msapi/validateuser/batch call
+batch_max_tokens = int(os.getenv("BATCH_MAX_TOKENS", "100"))
+
+# --- Account Recovery Rate Limits ---
+# Token buckets per client IP and per target email/username, refilled at RECOVERY_*_RATE requests per minute.
+# At most RATE_LIMIT_MAX_KEYS buckets are kept per limiter; idle buckets are dropped once they would be full again.
+recovery_ip_rate = float(os.getenv("RECOVERY_IP_RATE", "5"))
+recovery_ip_burst = int(os.getenv("RECOVERY_IP_BURST", "10"))
+recovery_target_rate = float(os.getenv("RECOVERY_TARGET_RATE", "1"))
+recovery_target_burst = int(os.getenv("RECOVERY_TARGET_BURST", "3"))
+rate_limit_max_keys = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+
+# --- Logging ---
+# Records go through a queue to a background thread. LOG_FORMAT=json writes one JSON object per line.
+# ACCESS_LOG_SAMPLE_RATE of requests are access logged, plus every 5xx and every request slower than ACCESS_LOG_SLOW_MS.
+# Each distinct warning or error message may be logged ERROR_LOG_BURST times, then ERROR_LOG_RATE times per minute.
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+log_format = os.getenv("LOG_FORMAT", "json").lower()
+access_log_sample_rate = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "0.01"))
+access_log_slow_ms = float(os.getenv("ACCESS_LOG_SLOW_MS", "500"))
+error_log_rate = float(os.getenv("ERROR_LOG_RATE", "6"))
+error_log_burst = int(os.getenv("ERROR_LOG_BURST", "5"))
+
+# --- Static Pages ---
+# Login help and reset password pages are rendered once, stored compressed and cached by browsers for PAGE_CACHE_MAX_AGE seconds
+page_cache_max_age = int(os.getenv("PAGE_CACHE_MAX_AGE", "300"))
+
+# --- Health Checks ---
+# Readiness is answered from a background database check that runs every HEALTH_CHECK_INTERVAL seconds.
+# Set HEALTH_MAX_POOL_SATURATION (0-1) to also report not ready while the async pool is that full.
+health_check_interval = float(os.getenv("HEALTH_CHECK_INTERVAL", "5"))
+health_max_pool_saturation = float(os.getenv("HEALTH_MAX_POOL_SATURATION", "0") or "0")
 
 # JWT secret for password reset tokens (different from login tokens!)
 RESET_SECRET_KEY = os.getenv("RESET_KEY", "")
@@ -100,6 +571,734 @@ def verify_password_reset_token(token: str) -> Optional[str]:
         return None
 
 
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire a fixed number of seconds after they are stored.
+    Keeps hit/miss counters so the effectiveness of the cache can be monitored.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+class SharedTTLCache:
+    """
+    Fixed-size cache of integer values in an anonymous shared memory map that survives fork.
+    Each key hashes to a group of WAYS slots and a full group evicts its entry closest to expiry, so colliding keys
+    do not keep evicting each other. A checksum over each slot lets readers skip entries torn by a concurrent write.
+    """
+
+    SLOT = struct.Struct("<16sqd8s")
+    WAYS = 8
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._groups = max(-(-maxsize // self.WAYS), 1)
+        self._group_size = self.WAYS * self.SLOT.size
+        self._map = mmap.mmap(-1, self._groups * self._group_size)
+
+    @staticmethod
+    def _digest(key) -> bytes:
+        return hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).digest()
+
+    @staticmethod
+    def _checksum(digest: bytes, value: int, expires: float) -> bytes:
+        return hashlib.blake2b(struct.pack("<16sqd", digest, value, expires), digest_size=8).digest()
+
+    def _group(self, digest: bytes) -> int:
+        return int.from_bytes(digest[:8], "little") % self._groups * self._group_size
+
+    def get(self, key, default=None):
+        if self.maxsize > 0:
+            digest = self._digest(key)
+            start = self._group(digest)
+            # Wall clock expiry, since the entries are shared between processes
+            now = time.time()
+            for stored, value, expires, check in self.SLOT.iter_unpack(self._map[start : start + self._group_size]):
+                if stored == digest and expires > now and check == self._checksum(digest, value, expires):
+                    self.hits += 1
+                    return value
+        self.misses += 1
+        return default
+
+    def set(self, key, value: int):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        digest = self._digest(key)
+        start = self._group(digest)
+        # Reuse the key's own slot, otherwise take the empty, expired or soonest-expiring one
+        victim, victim_expires = start, float("inf")
+        for way, (stored, _, expires, _) in enumerate(self.SLOT.iter_unpack(self._map[start : start + self._group_size])):
+            if stored == digest:
+                victim = start + way * self.SLOT.size
+                break
+            if expires < victim_expires:
+                victim, victim_expires = start + way * self.SLOT.size, expires
+        expires = time.time() + self.ttl
+        self.SLOT.pack_into(self._map, victim, digest, value, expires, self._checksum(digest, value, expires))
+
+    def __len__(self) -> int:
+        now = time.time()
+        return sum(1 for _, _, expires, _ in self.SLOT.iter_unpack(self._map) if expires > now)
+
+    def stats(self) -> dict:
+        return {"size": len(self), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+if session_cache_shared:
+    session_cache = SharedTTLCache(session_cache_size, session_cache_ttl)
+else:
+    session_cache = TTLCache(session_cache_size, session_cache_ttl)
+rejected_tokens = TTLCache(reject_cache_size, reject_cache_ttl)
+
+
+class CacheCollector:
+    """
+    Exposes the hit/miss counters and size of in-process caches to Prometheus.
+    """
+
+    def __init__(self, caches: dict):
+        self.caches = caches
+
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "Cache lookups answered from memory", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Cache lookups that fell through", labels=["cache"])
+        size = GaugeMetricFamily("cache_entries", "Entries currently held in the cache", labels=["cache"])
+        for name, memcache in self.caches.items():
+            stats = memcache.stats()
+            hits.add_metric([name], stats["hits"])
+            misses.add_metric([name], stats["misses"])
+            size.add_metric([name], stats["size"])
+        yield hits
+        yield misses
+        yield size
+
+
+cache_collector = CacheCollector({"session": session_cache, "rejected": rejected_tokens})
+REGISTRY.register(cache_collector)
+
+
+def pool_stats(pool) -> dict:
+    """
+    Returns the current occupancy of a SQLAlchemy queue pool.
+    """
+    capacity = pool.size() + db_max_overflow
+    checked_out = pool.checkedout()
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": checked_out,
+        "overflow": max(pool.overflow(), 0),
+        "saturation": checked_out / capacity if capacity > 0 else 0.0,
+    }
+
+
+class PoolCollector:
+    """
+    Exposes live connection pool occupancy to Prometheus.
+    """
+
+    def __init__(self, engines: dict):
+        self.engines = engines
+
+    def collect(self):
+        gauges = {
+            name: GaugeMetricFamily(f"db_pool_{name}", f"Connection pool {name.replace('_', ' ')}", labels=["engine"]) for name in ("size", "checked_in", "checked_out", "overflow", "saturation")
+        }
+        for label, db_engine in self.engines.items():
+            for name, value in pool_stats(db_engine.pool).items():
+                gauges[name].add_metric([label], value)
+        yield from gauges.values()
+
+
+pool_collector = PoolCollector({"async": async_engine})
+REGISTRY.register(pool_collector)
+
+
+class MultiprocessPublisher:
+    """
+    Copies the samples of scrape-time collectors and function gauges into the multiprocess metrics files.
+    A multiprocess scrape only reads those files, so without this it would miss every worker's live values.
+    """
+
+    def __init__(self, collectors: list, gauges: list):
+        self.collectors = collectors
+        self.gauges = gauges
+        self._metrics: dict = {}
+        self._counted: dict = {}
+
+    def publish(self):
+        for collector in self.collectors:
+            for family in collector.collect():
+                for sample in family.samples:
+                    self._record(family, sample)
+        # set_function gauges report in-process only; set() stores the current value in the worker's file as well
+        for gauge in self.gauges:
+            for family in gauge.collect():
+                gauge.set(family.samples[0].value)
+
+    def _record(self, family, sample):
+        if family.type == "counter" and not sample.name.endswith("_total"):
+            return
+        metric = self._metrics.get(family.name)
+        if metric is None:
+            # Not registered: the multiprocess scrape reads their files, and the in-process registry keeps the collectors
+            if family.type == "counter":
+                metric = Counter(family.name, family.documentation, list(sample.labels), registry=None)
+            else:
+                metric = Gauge(family.name, family.documentation, list(sample.labels), registry=None, multiprocess_mode="liveall")
+            self._metrics[family.name] = metric
+        child = metric.labels(**sample.labels) if sample.labels else metric
+        if family.type == "counter":
+            # Counters only move forward, so the increase since the last publish is added
+            key = (family.name, tuple(sample.labels.values()))
+            increase = sample.value - self._counted.get(key, 0)
+            if increase > 0:
+                child.inc(increase)
+            self._counted[key] = sample.value
+        else:
+            child.set(sample.value)
+
+
+class TokenBucketLimiter:
+    """
+    Per-key token buckets held in a bounded LRU.
+    A bucket left idle long enough to refill completely carries no state, so it is dropped.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, maxsize: int):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.maxsize = maxsize
+        self.idle_after = burst / self.rate if self.rate > 0 else float("inf")
+        self._buckets: OrderedDict = OrderedDict()
+
+    def try_acquire(self, key) -> float:
+        """
+        Takes one token for the key. Returns 0 when allowed, otherwise the seconds until a token is available.
+        """
+        now = time.monotonic()
+        while self._buckets:
+            oldest, (_, last) = next(iter(self._buckets.items()))
+            if now - last < self.idle_after:
+                break
+            del self._buckets[oldest]
+
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate if self.rate > 0 else 60.0
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+recovery_ip_limiter = TokenBucketLimiter(recovery_ip_rate, recovery_ip_burst, rate_limit_max_keys)
+recovery_target_limiter = TokenBucketLimiter(recovery_target_rate, recovery_target_burst, rate_limit_max_keys)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one JSON object, merging in any structured fields passed as extra={"fields": {...}}.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, UTC).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class ErrorRateFilter(logging.Filter):
+    """
+    Drops repeats of the same warning or error message beyond the limiter's rate, so an outage cannot flood the log.
+    The next record let through for that message carries the number dropped in the meantime.
+    """
+
+    def __init__(self, limiter: TokenBucketLimiter):
+        super().__init__()
+        self.limiter = limiter
+        self._suppressed: dict = defaultdict(int)
+        # Records also arrive from worker threads such as the mail senders
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        # Keyed on the unformatted message so the same failure with different details counts once
+        key = (record.name, str(record.msg))
+        with self._lock:
+            if self.limiter.try_acquire(key) > 0:
+                self._suppressed[key] += 1
+                return False
+            record.suppressed = self._suppressed.pop(key, 0)
+        return True
+
+
+class LogPipeline:
+    """
+    Hands log records to a background thread through a queue so the event loop never blocks writing stdout.
+    """
+
+    def __init__(self, output: logging.Handler):
+        self.output = output
+        self.handler = QueueHandler(queue.SimpleQueue())
+        self.listener: Optional[QueueListener] = None
+        self.start()
+        # Workers forked from a preloaded app do not inherit the listener thread, so each starts its own
+        os.register_at_fork(after_in_child=self.restart)
+        # Stopped at interpreter exit rather than with the app, so records logged during shutdown are still written
+        atexit.register(self.stop)
+
+    def start(self):
+        self.listener = QueueListener(self.handler.queue, self.output)
+        self.listener.start()
+
+    def restart(self):
+        self.handler.queue = queue.SimpleQueue()
+        self.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+def configure_logging() -> LogPipeline:
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter("%(levelname)s:     %(message)s"))
+    pipeline = LogPipeline(output)
+    pipeline.handler.addFilter(ErrorRateFilter(TokenBucketLimiter(error_log_rate, error_log_burst, 1000)))
+    root = logging.getLogger()
+    root.handlers = [pipeline.handler]
+    root.setLevel(log_level)
+    # The access log below replaces uvicorn's, which writes to stdout synchronously on every request
+    logging.getLogger("uvicorn.access").disabled = True
+    return pipeline
+
+
+log_pipeline = configure_logging()
+access_logger = logging.getLogger("access")
+request_db_time: ContextVar[Optional[list]] = ContextVar("request_db_time", default=None)
+
+
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+
+def end_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["statement_started"].pop()
+    db_time = request_db_time.get()
+    if db_time is not None:
+        db_time[0] += elapsed
+
+
+def fail_statement_timer(exception_context):
+    started = exception_context.connection.info.get("statement_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+# Statement time is added up per request for the access log
+event.listen(async_engine.sync_engine, "before_cursor_execute", start_statement_timer)
+event.listen(async_engine.sync_engine, "after_cursor_execute", end_statement_timer)
+event.listen(async_engine.sync_engine, "handle_error", fail_statement_timer)
+
+
+def log_access(method: str, route: str, status_code: int, latency: float, db_time: float):
+    """
+    Writes a sampled structured access log entry. Server errors and slow requests are always logged.
+    """
+    if status_code < 500 and latency * 1000 < access_log_slow_ms and random.random() >= access_log_sample_rate:
+        return
+    fields = {
+        "method": method,
+        "route": route,
+        "status": status_code,
+        "latency_ms": round(latency * 1000, 3),
+        "db_ms": round(db_time * 1000, 3),
+    }
+    access_logger.info("%s %s %d", method, route, status_code, extra={"fields": fields})
+
+
+def check_recovery_rate(request: Request, target: str):
+    """
+    Rejects account recovery requests over the per-client or per-target rate with 429, before any database work.
+    """
+    route = request.url.path
+    # The server resolves X-Forwarded-For into request.client only for proxies listed in FORWARDED_ALLOW_IPS
+    client_ip = request.client.host if request.client else ""
+    for limiter_name, limiter, key in (("ip", recovery_ip_limiter, client_ip), ("target", recovery_target_limiter, f"{route}:{target.lower()}")):
+        wait = limiter.try_acquire(key)
+        if wait > 0:
+            RATE_LIMITED.labels(route, limiter_name).inc()
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests. Please try again later.",
+                headers={"Retry-After": str(max(1, round(wait)))},
+            )
+
+
+class LastSeenBuffer:
+    """
+    Collects lastseen touches in memory and writes them to dm.dm_user_auth as one batched statement.
+    Repeated touches of the same session between flushes collapse into a single row update.
+    """
+
+    def __init__(self):
+        self._pending: set[tuple[int, str]] = set()
+
+    def touch(self, userid: int, uuid: str):
+        self._pending.add((userid, uuid))
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+
+        pending = self._pending
+        self._pending = set()
+
+        # Replicas flush overlapping sessions, so rows are locked in (id, jti) order to avoid deadlocking each other
+        usql = """UPDATE dm.dm_user_auth AS a SET lastseen = current_timestamp at time zone 'UTC'
+                  FROM (SELECT l.id, l.jti FROM dm.dm_user_auth l
+                        INNER JOIN unnest(CAST(:ids AS integer[]), CAST(:jtis AS text[])) AS t(id, jti) ON l.id = t.id AND l.jti = t.jti
+                        ORDER BY l.id, l.jti
+                        FOR UPDATE OF l) AS t
+                  WHERE a.id = t.id AND a.jti = t.jti"""
+        ordered = sorted(pending)
+        params = {"ids": [userid for userid, _ in ordered], "jtis": [uuid for _, uuid in ordered]}
+        try:
+            with traced_stage("lastseen_update"):
+                async with db_connect(begin=True) as conn:
+                    await conn.execute(text(usql), params)
+        except Exception:
+            # Keep the touches so the next flush retries them
+            self._pending |= pending
+            raise
+        return len(pending)
+
+
+lastseen_buffer = LastSeenBuffer()
+
+
+class DomainIndex:
+    """
+    In-memory copy of the active domain tree.
+    Answers the same question as the recursive parents CTE without a database round-trip.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.version = 0
+        self.loaded_at = 0.0
+        self._parent: dict[int, Optional[int]] = {}
+        self._children: dict[int, list[int]] = {}
+        self._lists: dict[int, tuple[int, ...]] = {}
+        self._bodies: dict[int, tuple[bytes, str]] = {}
+
+    def build(self, rows):
+        """
+        Rebuilds the index from (id, domainid) rows of active domains.
+        Only domains reachable from an active root are indexed, matching the recursive CTE.
+        """
+        children = defaultdict(list)
+        roots = []
+        for domid, parentid in rows:
+            if parentid is None:
+                roots.append(domid)
+            else:
+                children[parentid].append(domid)
+
+        parent: dict[int, Optional[int]] = {root: None for root in roots}
+        stack = list(roots)
+        while stack:
+            domid = stack.pop()
+            for child in children.get(domid, []):
+                if child not in parent:
+                    parent[child] = domid
+                    stack.append(child)
+
+        self._parent = parent
+        self._children = {domid: kids for domid, kids in children.items() if domid in parent}
+        self._lists = {}
+        self._bodies = {}
+        self.version += 1
+        self.loaded_at = time.time()
+        self.loaded = True
+
+    def domain_list(self, domainid: int) -> list[int]:
+        """
+        Returns the domain, its ancestors and its descendants, or [-1] when the domain is not in the active tree.
+        The answer for each domain is computed once per index version.
+        """
+        ids = self._lists.get(domainid)
+        if ids is None:
+            if domainid not in self._parent:
+                return [-1]
+            found = set()
+            ancestor = domainid
+            while ancestor is not None:
+                found.add(ancestor)
+                ancestor = self._parent[ancestor]
+            stack = list(self._children.get(domainid, []))
+            while stack:
+                child = stack.pop()
+                found.add(child)
+                stack.extend(self._children.get(child, []))
+            ids = tuple(sorted(found))
+            self._lists[domainid] = ids
+        return list(ids)
+
+    def domain_list_body(self, domainid: int) -> tuple[bytes, str]:
+        """
+        Returns the serialized DomainList and ETag for a domain, built once per index version.
+        """
+        body = self._bodies.get(domainid)
+        if body is None:
+            body = serialize_domain_list(self.domain_list(domainid))
+            self._bodies[domainid] = body
+        return body
+
+    def __len__(self) -> int:
+        return len(self._parent)
+
+    async def refresh(self):
+        async with db_connect() as conn:
+            result = await conn.execute(text("SELECT id, domainid FROM dm.dm_domain WHERE status = 'N'"))
+            rows = result.fetchall()
+        self.build(rows)
+
+
+domain_index = DomainIndex()
+
+
+async def install_sql(path: str, table: str, version: str, substitutions: Optional[dict] = None):
+    """
+    Runs a service-owned SQL script unless the comment on its table already records this version.
+    {name} placeholders are replaced by the substitution values with single quotes doubled, for use in SQL literals.
+    """
+    check = text("SELECT obj_description(to_regclass(:table), 'pg_class')")
+    async with db_connect(begin=True) as conn:
+        if await conn.scalar(check, {"table": table}) == version:
+            return
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:lockid)"), {"lockid": schema_lock_id})
+        # Another replica may have finished the install while this one waited for the lock
+        if await conn.scalar(check, {"table": table}) == version:
+            return
+        with open(path, "r") as sqlfile:
+            script = sqlfile.read()
+        for name, value in (substitutions or {}).items():
+            script = script.replace(f"{{{name}}}", value.replace("'", "''"))
+        comment = version.replace("'", "''")
+        script += f"\nCOMMENT ON TABLE {table} IS '{comment}';\n"
+        # The script holds several statements, which only the simple query protocol accepts
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.execute(script)
+        logging.info("Installed %s", version)
+
+
+class DomainClosure:
+    """
+    Service-owned dm.dm_domain_closure table of (ancestor, descendant, depth) rows for the active domain tree.
+    A trigger on dm.dm_domain keeps it current, so a domain list is two index range scans at any tree size.
+    """
+
+    VERSION = "ms-validate-user domain closure v1"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ready = False
+
+    async def install(self):
+        """
+        Creates or upgrades the table, functions and trigger and fills the table, unless this version is already there.
+        """
+        version = f"{self.VERSION} notify={domain_notify_channel}"
+        await install_sql(self.path, "dm.dm_domain_closure", version, {"channel": domain_notify_channel})
+        self.ready = True
+
+    async def domain_list(self, conn, domainid: int) -> list[int]:
+        """
+        Returns the domain, its ancestors and its descendants, or [-1] when the domain is not in the active tree.
+        """
+        sqlstmt = """SELECT ARRAY_AGG(ids.id ORDER BY ids.id)
+                     FROM (SELECT ancestor AS id FROM dm.dm_domain_closure WHERE descendant = :domainid
+                           UNION
+                           SELECT descendant FROM dm.dm_domain_closure WHERE ancestor = :domainid) AS ids
+                     WHERE EXISTS (SELECT 1
+                                   FROM dm.dm_domain_closure top INNER JOIN dm.dm_domain root ON root.id = top.ancestor
+                                   WHERE top.descendant = :domainid AND root.domainid IS NULL)"""
+
+        result = await conn.execute(text(sqlstmt), {"domainid": domainid})
+        row = result.fetchone()
+        return list(row[0]) if row and row[0] else [-1]
+
+
+domain_closure = DomainClosure(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "dm_domain_closure.sql"))
+
+
+class RevocationList:
+    """
+    jtis of sessions deleted from dm.dm_user_auth, mirrored from dm.dm_user_auth_revoked by incremental syncs.
+    """
+
+    VERSION = "ms-validate-user revoked sessions v2"
+    # Rows are re-read for a minute behind the newest one seen, so revocations committed late are not missed
+    OVERLAP = 60.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.installed = False
+        # Sessions deleted before the log existed were never recorded, so older tokens are not trusted
+        self.recorded_since = float("inf")
+        self.synced_at = 0.0
+        self._since = 0.0
+        self._revoked: dict[str, float] = {}
+
+    def trusts(self, lifetime: float, issued_at: float) -> bool:
+        """
+        True when a token with this lifetime and iat can be validated from the list alone.
+        """
+        return session_purge_interval > 0 and lifetime <= revocation_retention and issued_at >= self.recorded_since and time.monotonic() - self.synced_at <= revocation_max_staleness
+
+    def is_revoked(self, uuid: str) -> bool:
+        return uuid in self._revoked
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    async def install(self):
+        await install_sql(self.path, "dm.dm_user_auth_revoked", self.VERSION)
+        async with db_connect() as conn:
+            since = await conn.scalar(text("SELECT EXTRACT(EPOCH FROM since) FROM dm.dm_user_auth_revoked_since"))
+        self.recorded_since = float(since)
+        self.installed = True
+
+    async def sync(self):
+        """
+        Adds the sessions revoked since the last sync and forgets revocations older than the retention window.
+        """
+        sqlstmt = """SELECT jti, EXTRACT(EPOCH FROM revoked_at)
+                     FROM dm.dm_user_auth_revoked
+                     WHERE revoked_at >= to_timestamp(:since)"""
+        async with db_connect() as conn:
+            result = await conn.execute(text(sqlstmt), {"since": max(self._since - self.OVERLAP, 0.0)})
+            rows = result.fetchall()
+        for uuid, revoked_at in rows:
+            self._revoked[uuid] = float(revoked_at)
+            self._since = max(self._since, float(revoked_at))
+        cutoff = time.time() - revocation_retention
+        self._revoked = {uuid: revoked_at for uuid, revoked_at in self._revoked.items() if revoked_at >= cutoff}
+        self.synced_at = time.monotonic()
+
+
+revocation_list = RevocationList(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "dm_user_auth_revoked.sql"))
+REVOKED_SESSIONS.set_function(lambda: len(revocation_list))
+domain_index_changed = asyncio.Event()
+
+
+class PublicKeyCache:
+    """
+    Parsed RS256 verification key for login tokens.
+    The key text is only re-parsed when the key file's mtime or the bootstrap row changes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.key = None
+        self._pem = None
+        self._mtime = None
+        self._checked = 0.0
+
+    def _parse(self, pem: str):
+        if pem == self._pem:
+            return
+        self._pem = pem
+        try:
+            self.key = jwt.algorithms.RSAAlgorithm(jwt.algorithms.RSAAlgorithm.SHA256).prepare_key(pem)
+        except Exception as err:
+            logging.error("Unable to parse login token public key: %s", err)
+            self.key = None
+
+    async def get(self):
+        if os.path.exists(self.path):
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self._mtime:
+                with open(self.path, "r") as keyfile:
+                    self._parse(keyfile.read())
+                self._mtime = mtime
+            return self.key
+
+        now = time.monotonic()
+        if self.key is None or now - self._checked >= key_refresh_interval:
+            self._checked = now
+            try:
+                async with db_connect() as conn:
+                    self._parse(await load_bootstrap_key(conn))
+            except Exception as err:
+                # Keep verifying with the previous key until the bootstrap row can be read again
+                if self.key is None:
+                    self._checked = 0.0
+                    raise
+                logging.error("Unable to refresh login token public key: %s", err)
+        return self.key
+
+
+public_key_cache = PublicKeyCache(id_rsa_pub)
+
+
 # -----------------------------
 # Health check endpoint
 # -----------------------------
@@ -108,21 +1307,82 @@ class StatusMsg(BaseModel):
     service_name: str = ""
 
 
+class ReadyMsg(StatusMsg):
+    detail: str = ""
+    checked_at: float = 0.0
+    pool_saturation: float = 0.0
+
+
+class DbHealth:
+    """
+    Result of the most recent background database check.
+    """
+
+    def __init__(self):
+        self.up = False
+        self.detail = "Database not checked yet"
+        self.checked_at = 0.0
+
+    def record(self, up: bool, detail: str = ""):
+        self.up = up
+        self.detail = detail
+        self.checked_at = time.time()
+
+    def is_stale(self) -> bool:
+        # A checker that stopped reporting must not keep the pod ready forever
+        return time.time() - self.checked_at > max(3 * health_check_interval, 30)
+
+
+db_health = DbHealth()
+
+
+async def db_health_checker():
+    """
+    Background task that checks the database on a fixed interval so probes never touch it.
+    """
+    while True:
+        try:
+            async with db_connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            db_health.record(True)
+        except Exception as err:
+            db_health.record(False, str(err))
+        await asyncio.sleep(health_check_interval)
+
+
+def readiness() -> ReadyMsg:
+    saturation = pool_stats(async_engine.pool)["saturation"]
+    msg = ReadyMsg(status="UP", service_name=service_name, detail=db_health.detail, checked_at=db_health.checked_at, pool_saturation=saturation)
+    if not db_health.up:
+        msg.status = "DOWN"
+    elif db_health.is_stale():
+        msg.status = "DOWN"
+        msg.detail = "Database check is stale"
+    elif health_max_pool_saturation > 0 and saturation >= health_max_pool_saturation:
+        msg.status = "DOWN"
+        msg.detail = "Connection pool saturated"
+    return msg
+
+
 @app.get("/health")
 async def health(response: Response) -> StatusMsg:
-    try:
-        with engine.connect() as connection:
-            conn = connection.connection
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-            if cursor.rowcount > 0:
-                return StatusMsg(status="UP", service_name=service_name)
-            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
-            return StatusMsg(status="DOWN", service_name=service_name)
-    except Exception as err:
-        print(str(err))
+    ready = readiness()
+    if ready.status != "UP":
         response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
-        return StatusMsg(status="DOWN", service_name=service_name)
+    return StatusMsg(status=ready.status, service_name=service_name)
+
+
+@app.get("/health/live")
+async def health_live() -> StatusMsg:
+    return StatusMsg(status="UP", service_name=service_name)
+
+
+@app.get("/health/ready")
+async def health_ready(response: Response) -> ReadyMsg:
+    ready = readiness()
+    if ready.status != "UP":
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return ready
 
 
 # -----------------------------
@@ -136,144 +1396,606 @@ class DomainList(BaseModel):
     domains: list[int] = []
 
 
-@app.get("/msapi/validateuser")
-async def validateuser(request: Request, domains: Optional[str] = Query(None, regex="^[y|Y|n|N]$")) -> DomainList:
-    # (existing validateuser code unchanged)
-    userid = -1
-    uuid = ""
-    global public_key
-    domlist = DomainList()
+class TokenBatch(BaseModel):
+    tokens: list[str] = []
+
+
+class TokenValidation(BaseModel):
+    valid: bool = False
+    detail: str = ""
+    domains: list[int] = []
+
+
+class TokenValidationList(BaseModel):
+    results: list[TokenValidation] = []
+
+
+@asynccontextmanager
+async def db_connect(begin: bool = False):
+    """
+    Checks out a pooled async connection, recording how long the checkout took.
+    With begin=True the connection runs in a transaction that commits on exit.
+    Connection failures feed the circuit breaker, which refuses checkouts while open.
+    """
+    if not db_breaker.allow():
+        DB_BREAKER_REJECTS.inc()
+        raise DatabaseUnavailable("Database unavailable")
+    start = time.perf_counter()
+    checkout = tracer.start_span("db.checkout") if span_wanted() else trace.INVALID_SPAN
     try:
-        no_of_retry = db_conn_retry
-        attempt = 1
-        while True:
-            try:
-                with engine.connect() as connection:
-                    conn = connection.connection
-                    authorized = False
-
-                    if not os.path.exists(id_rsa_pub):
-                        try:
-                            cursor = conn.cursor()
-                            cursor.execute("select bootstrap from dm.dm_tableinfo limit 1")
-                            row = cursor.fetchone()
-                            while row:
-                                public_key = base64.b64decode(row[0]).decode("utf-8")
-                                row = cursor.fetchone()
-                            cursor.close()
-                        except Exception as err:
-                            print(str(err))
-
-                    token = request.cookies.get("token", None)
-                    if token is None:
-                        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authorization Failed")
-                    try:
-                        decoded = jwt.decode(token, public_key, algorithms=["RS256"])
-                        userid = decoded.get("sub", None)
-                        uuid = decoded.get("jti", None)
-                        if userid is None or uuid is None:
-                            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid login token")
-                    except jwt.InvalidTokenError as err:
-                        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(err)) from None
-
-                    csql = "DELETE from dm.dm_user_auth where lastseen < current_timestamp at time zone 'UTC' - interval '1 hours'"
-                    sqlstmt = "select count(*) from dm.dm_user_auth where id = (%s) and jti = (%s)"
-
-                    cursor = conn.cursor()
-                    cursor.execute(csql)
-                    cursor.close()
-                    conn.commit()
-
-                    params = tuple([userid, uuid])
-                    cursor = conn.cursor()
-                    cursor.execute(sqlstmt, params)
-                    row = cursor.fetchone()
-                    rowcnt = 0
-                    while row:
-                        rowcnt = row[0]
-                        row = cursor.fetchone()
-                    cursor.close()
-
-                    if rowcnt > 0:
-                        authorized = True
-                        usql = "update dm.dm_user_auth set lastseen = current_timestamp at time zone 'UTC' where id = (%s) and jti = (%s)"
-                        params = tuple([userid, uuid])
-                        cursor = conn.cursor()
-                        cursor.execute(usql, params)
-                        cursor.close()
-                        conn.commit()
-
-                    if not authorized:
-                        conn.close()
-                        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authorization Failed")
-
-                    if domains is not None and domains.lower() == "y":
-                        domainid = -1
-                        sqlstmt = "SELECT domainid FROM dm.dm_user WHERE id = (%s)"
-                        cursor = conn.cursor()
-                        params = tuple([userid])
-                        cursor.execute(sqlstmt, params)
-                        row = cursor.fetchone()
-                        while row:
-                            domainid = row[0] if row[0] else -1
-                            row = cursor.fetchone()
-                        cursor.close()
-
-                        sqlstmt = """WITH RECURSIVE parents AS
-                                    (SELECT
-                                            id              AS id,
-                                            ARRAY [id]      AS ancestry,
-                                            NULL :: INTEGER AS parent,
-                                            id              AS start_of_ancestry
-                                        FROM dm.dm_domain
-                                        WHERE
-                                            domainid IS NULL and status = 'N'
-                                        UNION
-                                        SELECT
-                                            child.id                                    AS id,
-                                            array_append(p.ancestry, child.id)          AS ancestry,
-                                            child.domainid                              AS parent,
-                                            coalesce(p.start_of_ancestry, child.domainid) AS start_of_ancestry
-                                        FROM dm.dm_domain child
-                                            INNER JOIN parents p ON p.id = child.domainid AND child.status = 'N'
-                                        )
-                                        SELECT ARRAY_AGG(c)
-                                        FROM
-                                        (SELECT DISTINCT UNNEST(ancestry)
-                                            FROM parents
-                                            WHERE id = (%s) OR (%s) = ANY(parents.ancestry)) AS CT(c)"""
-
-                        cursor = conn.cursor()
-                        params = tuple([domainid, domainid])
-                        cursor.execute(sqlstmt, params)
-                        row = cursor.fetchone()
-                        while row:
-                            domainid = row[0] if row[0] else -1
-                            domlist.domains.append(domainid)
-                            row = cursor.fetchone()
-                    conn.close()
-                return domlist
-
-            except (InterfaceError, OperationalError) as ex:
-                if attempt < no_of_retry:
-                    sleep_for = 0.2
-                    logging.error(
-                        "Database connection error: %s - sleeping for %d seconds and will retry (attempt #%d of %d)",
-                        ex,
-                        sleep_for,
-                        attempt,
-                        no_of_retry,
+        async with async_engine.begin() if begin else async_engine.connect() as conn:
+            checkout.end()
+            DB_CHECKOUT_LATENCY.observe(time.perf_counter() - start)
+            yield conn
+    except db_retry_errors:
+        db_breaker.record_failure()
+        raise
+    except Exception:
+        # The database answered, so the failure is not a connectivity problem
+        db_breaker.record_success()
+        raise
+    else:
+        db_breaker.record_success()
+    finally:
+        # Still open only when the checkout itself failed
+        if checkout.is_recording():
+            checkout.set_status(Status(StatusCode.ERROR, "checkout failed"))
+            checkout.end()
+
+
+async def load_bootstrap_key(conn) -> str:
+    """
+    Reads the login token public key from dm.dm_tableinfo when no RSA_FILE is mounted.
+    """
+    result = await conn.execute(text("select bootstrap from dm.dm_tableinfo limit 1"))
+    row = result.fetchone()
+    if row:
+        return base64.b64decode(row[0]).decode("utf-8")
+    return ""
+
+
+def decode_login_token(token: str, key) -> tuple[int, str, float, float]:
+    """
+    Verifies the RS256 login token and returns the (userid, jti) pair that identifies the session,
+    plus the token's lifetime in seconds (infinite when it lacks exp or iat) and its iat (0 when missing).
+    """
+    try:
+        decoded = jwt.decode(token, key, algorithms=["RS256"])
+        userid = decoded.get("sub", None)
+        uuid = decoded.get("jti", None)
+        if userid is None or uuid is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid login token")
+        lifetime = float("inf")
+        issued_at = float(decoded.get("iat", 0))
+        if "exp" in decoded and "iat" in decoded:
+            lifetime = float(decoded["exp"]) - issued_at
+        # asyncpg binds parameters with their server-side types, so the subject must be an integer user id
+        return int(userid), str(uuid), lifetime, issued_at
+    except (jwt.InvalidTokenError, ValueError, TypeError) as err:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(err)) from None
+
+
+async def check_session(conn, userid: int, uuid: str) -> Optional[int]:
+    """
+    Checks that the session exists and has been used within the last hour, and looks up the user's home domain
+    in the same round-trip. Returns the domain id (-1 when the user has none), or None when there is no such session.
+    """
+    # asyncpg prepares each distinct statement once per pooled connection and reuses it afterwards (not in PgBouncer mode)
+    # Idle sessions are rejected here; the reaper only reclaims their rows
+    sqlstmt = """SELECT u.domainid
+                 FROM dm.dm_user_auth a LEFT JOIN dm.dm_user u ON u.id = a.id
+                 WHERE a.id = :userid AND a.jti = :jti
+                   AND a.lastseen >= current_timestamp at time zone 'UTC' - interval '1 hours'
+                 LIMIT 1"""
+
+    result = await conn.execute(text(sqlstmt), {"userid": userid, "jti": uuid})
+    row = result.fetchone()
+    if row is None:
+        return None
+    return row[0] if row[0] else -1
+
+
+async def user_domain(conn, userid: int) -> int:
+    """
+    Looks up the user's home domain (-1 when the user has none) for sessions validated without dm.dm_user_auth.
+    """
+    result = await conn.execute(text("SELECT domainid FROM dm.dm_user WHERE id = :userid"), {"userid": userid})
+    domainid = result.scalar()
+    return domainid if domainid else -1
+
+
+async def check_sessions(conn, sessions: list[tuple[int, str]]) -> list:
+    """
+    Looks up the (userid, jti, domainid) rows for a batch of (userid, jti) sessions used within the last hour
+    in one round-trip.
+    """
+    sqlstmt = """SELECT a.id, a.jti, u.domainid
+                 FROM unnest(CAST(:ids AS integer[]), CAST(:jtis AS text[])) AS t(id, jti)
+                     INNER JOIN dm.dm_user_auth a ON a.id = t.id AND a.jti = t.jti
+                     LEFT JOIN dm.dm_user u ON u.id = a.id
+                 WHERE a.lastseen >= current_timestamp at time zone 'UTC' - interval '1 hours'"""
+
+    result = await conn.execute(text(sqlstmt), {"ids": [userid for userid, _ in sessions], "jtis": [uuid for _, uuid in sessions]})
+    return result.fetchall()
+
+
+async def user_domains(conn, userids: list[int]) -> dict[int, int]:
+    """
+    Batch form of user_domain for sessions validated without dm.dm_user_auth.
+    """
+    result = await conn.execute(text("SELECT id, domainid FROM dm.dm_user WHERE id = ANY(CAST(:userids AS integer[]))"), {"userids": userids})
+    domains = dict.fromkeys(userids, -1)
+    for userid, domainid in result:
+        domains[userid] = domainid if domainid else -1
+    return domains
+
+
+async def query_domain_list(conn, domainid: int) -> list[int]:
+    """
+    Returns the ids of the domain, its ancestors and its descendants straight from the database.
+    Used until the in-memory domain index has been loaded.
+    """
+    if domain_closure.ready:
+        return await domain_closure.domain_list(conn, domainid)
+
+    sqlstmt = """WITH RECURSIVE parents AS
+                (SELECT
+                        id              AS id,
+                        ARRAY [id]      AS ancestry,
+                        NULL :: INTEGER AS parent,
+                        id              AS start_of_ancestry
+                    FROM dm.dm_domain
+                    WHERE
+                        domainid IS NULL and status = 'N'
+                    UNION
+                    SELECT
+                        child.id                                    AS id,
+                        array_append(p.ancestry, child.id)          AS ancestry,
+                        child.domainid                              AS parent,
+                        coalesce(p.start_of_ancestry, child.domainid) AS start_of_ancestry
+                    FROM dm.dm_domain child
+                        INNER JOIN parents p ON p.id = child.domainid AND child.status = 'N'
                     )
-                    sleep(sleep_for)
-                    attempt += 1
-                    continue
-                else:
-                    raise
+                    SELECT ARRAY_AGG(c)
+                    FROM
+                    (SELECT DISTINCT UNNEST(ancestry)
+                        FROM parents
+                        WHERE id = :domainid OR :domainid = ANY(parents.ancestry)) AS CT(c)"""
+
+    result = await conn.execute(text(sqlstmt), {"domainid": domainid})
+    row = result.fetchone()
+    return list(row[0]) if row and row[0] else [-1]
+
+
+async def warm_up():
+    """
+    Fills the pool and the caches the first validations would otherwise wait for.
+    """
+
+    async def prime_connection():
+        # Held concurrently so each call gets its own pooled connection; asyncpg prepares the statements on first use
+        async with db_connect() as conn:
+            await check_session(conn, 0, "")
+            await check_sessions(conn, [])
+
+    await asyncio.gather(*(prime_connection() for _ in range(warmup_connections)))
+    db_health.record(True)
+    await get_public_key()
+    await domain_index.refresh()
+    logging.info("Warmed %d database connections, public key and %d domains", warmup_connections, len(domain_index))
+    if stateless_validation:
+        await revocation_list.install()
+        await revocation_list.sync()
+        logging.info("Loaded %d revoked sessions", len(revocation_list))
+
+
+async def revocation_syncer():
+    """
+    Background task that installs the revocation log if needed and keeps the revocation list in sync.
+    """
+    while True:
+        try:
+            if not revocation_list.installed:
+                await revocation_list.install()
+            await revocation_list.sync()
+        except Exception as err:
+            logging.error("Revocation list sync failed: %s", err)
+        await asyncio.sleep(revocation_sync_interval)
+
+
+async def domain_closure_installer():
+    """
+    Background task that installs the domain closure table, retrying until the database accepts it.
+    """
+    while True:
+        try:
+            await domain_closure.install()
+            return
+        except Exception as err:
+            # Retrying cannot help a role without DDL rights
+            if getattr(getattr(err, "orig", err), "sqlstate", None) == "42501":
+                logging.error("Domain closure not installed, the database user lacks the rights (set DOMAIN_CLOSURE=n): %s", err)
+                return
+            logging.error("Domain closure install failed, using the recursive query: %s", err)
+        await asyncio.sleep(domain_index_refresh)
+
+
+async def domain_index_refresher():
+    """
+    Background task that reloads the domain index on a fixed interval or when a change is signalled.
+    """
+    # An index loaded by the startup warm-up is current, so the first reload waits like any other
+    reload = not domain_index.loaded
+    while True:
+        domain_index_changed.clear()
+        if reload:
+            try:
+                await domain_index.refresh()
+            except Exception as err:
+                logging.error("Domain index refresh failed: %s", err)
+        reload = True
+        try:
+            await asyncio.wait_for(domain_index_changed.wait(), timeout=domain_index_refresh)
+        except TimeoutError:
+            pass
+
+
+async def domain_change_listener():
+    """
+    Background task that LISTENs for domain change notifications and triggers an index refresh.
+    Reconnects after failures and refreshes on every reconnect in case notifications were missed.
+    """
+    while True:
+        try:
+            conn = await asyncpg.connect(host=db_host, port=int(db_port), user=db_user, password=db_pass, database=db_name)
+            try:
+                await conn.add_listener(domain_notify_channel, lambda *args: domain_index_changed.set())
+                domain_index_changed.set()
+                while True:
+                    # Keep the listening connection alive and notice when it drops
+                    await asyncio.sleep(30)
+                    await conn.execute("SELECT 1")
+            finally:
+                await conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logging.error("Domain change listener failed: %s", err)
+        await asyncio.sleep(5)
+
+
+async def purge_expired_sessions() -> int:
+    """
+    Deletes sessions idle for more than an hour. Returns -1 when another replica holds the purge lock.
+    """
+    csql = "DELETE from dm.dm_user_auth where lastseen < current_timestamp at time zone 'UTC' - interval '1 hours'"
+
+    async with db_connect(begin=True) as conn:
+        result = await conn.execute(text("select pg_try_advisory_xact_lock(:lockid)"), {"lockid": session_purge_lock_id})
+        if not result.scalar():
+            return -1
+        result = await conn.execute(text(csql))
+        if revocation_list.installed:
+            rsql = "DELETE FROM dm.dm_user_auth_revoked WHERE revoked_at < now() - make_interval(secs => :retention)"
+            await conn.execute(text(rsql), {"retention": revocation_retention})
+        return result.rowcount
+
+
+async def session_reaper():
+    """
+    Background task that periodically purges expired sessions outside of the request path.
+    """
+    while True:
+        try:
+            deleted = await purge_expired_sessions()
+            if deleted > 0:
+                logging.info("Purged %d expired sessions", deleted)
+        except Exception as err:
+            logging.error("Expired session purge failed: %s", err)
+        await asyncio.sleep(session_purge_interval)
+
+
+async def metrics_publisher():
+    """
+    Background task that publishes this worker's live metric values for multiprocess scrapes.
+    """
+    while True:
+        try:
+            multiprocess_publisher.publish()
+        except Exception as err:
+            logging.error("Metrics publish failed: %s", err)
+        await asyncio.sleep(metrics_publish_interval)
 
+
+async def lastseen_flusher():
+    """
+    Background task that writes buffered lastseen touches on a fixed interval.
+    """
+    while True:
+        await asyncio.sleep(lastseen_flush_ms / 1000)
+        try:
+            await lastseen_buffer.flush()
+        except Exception as err:
+            logging.error("Lastseen flush failed: %s", err)
+
+
+async def db_retry(operation, *args):
+    """
+    Awaits operation(*args), retrying database connection errors up to db_conn_retry times
+    with exponential backoff and jitter. Answers 503 while the database circuit breaker is open.
+    """
+    no_of_retry = db_conn_retry
+    attempt = 1
+    while True:
+        try:
+            return await operation(*args)
+        except DatabaseUnavailable as err:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(err)) from None
+        except db_retry_errors as ex:
+            if db_breaker.is_open:
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database unavailable") from None
+            if attempt < no_of_retry:
+                DB_RETRIES.inc()
+                sleep_for = random.uniform(0, min(db_retry_max_delay, db_retry_base_delay * 2 ** (attempt - 1)))
+                logging.error(
+                    "Database connection error: %s - sleeping for %.2f seconds and will retry (attempt #%d of %d)",
+                    ex,
+                    sleep_for,
+                    attempt,
+                    no_of_retry,
+                )
+                await asyncio.sleep(sleep_for)
+                attempt += 1
+                continue
+            else:
+                raise
+
+
+async def get_public_key():
+    public_key = await public_key_cache.get()
+    if public_key is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Login token public key is not available")
+    return public_key
+
+
+async def resolve_domains(domainids) -> dict[int, list[int]]:
+    """
+    Returns the domain list for each of the given home domains.
+    """
+    if domain_index.loaded:
+        return {domainid: domain_index.domain_list(domainid) for domainid in domainids}
+    async with db_connect() as conn:
+        return {domainid: await query_domain_list(conn, domainid) for domainid in domainids}
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers with the same key share one in-flight call instead of each making it.
+    Nothing is kept once the call finishes, so results are never staler than the call itself.
+    """
+
+    def __init__(self):
+        self._calls: dict = {}
+
+    def _finished(self, key, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the outcome as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, operation, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(operation(*args))
+            self._calls[key] = task
+            task.add_done_callback(partial(self._finished, key))
+        else:
+            VALIDATIONS_COALESCED.inc()
+        # A waiter whose client disconnects must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+validation_flights = SingleFlight()
+
+
+def token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+async def validate_token(token: str, want_domains: bool) -> Optional[int]:
+    """
+    Validates one login token and returns the user's home domain id (-1 when none).
+    Tokens rejected within the last REJECT_CACHE_TTL seconds are answered from memory.
+    """
+    digest = token_digest(token)
+    detail = rejected_tokens.get(digest)
+    if detail is not None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=detail)
+    try:
+        return await check_token(token, want_domains)
+    except HTTPException as err:
+        if err.status_code == status.HTTP_401_UNAUTHORIZED:
+            rejected_tokens.set(digest, err.detail)
+        raise
+
+
+async def check_token(token: str, want_domains: bool) -> Optional[int]:
+    """
+    Validates one login token against its session and returns the user's home domain id.
+    In stateless mode the domain id is only looked up when wanted, and None is returned otherwise.
+    """
+    with traced_stage("key_load"):
+        public_key = await get_public_key()
+    with traced_stage("jwt_decode"):
+        userid, uuid, lifetime, issued_at = decode_login_token(token, public_key)
+
+    with traced_stage("session_check"):
+        stateless = stateless_validation and revocation_list.trusts(lifetime, issued_at)
+        if stateless and revocation_list.is_revoked(uuid):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authorization Failed")
+        # Repeat validations of a recently checked session are answered without touching Postgres
+        domainid = session_cache.get((userid, uuid))
+        if domainid is None and not stateless:
+            async with db_connect() as conn:
+                domainid = await check_session(conn, userid, uuid)
+            if domainid is None:
+                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authorization Failed")
+            session_cache.set((userid, uuid), domainid)
+        elif domainid is None and want_domains:
+            async with db_connect() as conn:
+                domainid = await user_domain(conn, userid)
+            session_cache.set((userid, uuid), domainid)
+    lastseen_buffer.touch(userid, uuid)
+    return domainid
+
+
+def serialize_domain_list(domains: list[int]) -> tuple[bytes, str]:
+    body = DomainList(domains=domains).model_dump_json().encode("utf-8")
+    return body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+async def domain_list_body(domainid: int) -> tuple[bytes, str]:
+    """
+    Returns the serialized DomainList response for a home domain and its ETag.
+    """
+    if domain_index.loaded:
+        return domain_index.domain_list_body(domainid)
+    async with db_connect() as conn:
+        return serialize_domain_list(await query_domain_list(conn, domainid))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def validate_tokens(tokens: list[str], want_domains: bool) -> TokenValidationList:
+    """
+    Validates a batch of login tokens, resolving every uncached session with a single query.
+    Sessions are checked the same way as check_token, including against the revocation list in stateless mode.
+    """
+    results = [TokenValidation() for _ in tokens]
+    sessions: dict[int, tuple[int, str]] = {}
+    # Positions whose session is trusted without dm.dm_user_auth; the same session can also arrive in a token that is not
+    stateless: set[int] = set()
+    digests = [token_digest(token) for token in tokens]
+
+    pending = []
+    for pos, digest in enumerate(digests):
+        detail = rejected_tokens.get(digest)
+        if detail is None:
+            pending.append(pos)
+        else:
+            results[pos].detail = detail
+
+    if pending:
+        public_key = await get_public_key()
+    for pos in pending:
+        try:
+            userid, uuid, lifetime, issued_at = decode_login_token(tokens[pos], public_key)
+            if stateless_validation and revocation_list.trusts(lifetime, issued_at):
+                if revocation_list.is_revoked(uuid):
+                    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authorization Failed")
+                stateless.add(pos)
+            sessions[pos] = (userid, uuid)
+        except HTTPException as err:
+            results[pos].detail = err.detail
+            rejected_tokens.set(digests[pos], err.detail)
+
+    found = {}
+    missing = set()
+    domainless = set()
+    for pos, session in sessions.items():
+        if session in found:
+            continue
+        domainid = session_cache.get(session)
+        if domainid is not None:
+            found[session] = domainid
+        elif pos not in stateless:
+            missing.add(session)
+        elif want_domains:
+            domainless.add(session)
+
+    home_domains = {}
+    if missing or domainless:
+        async with db_connect() as conn:
+            rows = await check_sessions(conn, sorted(missing)) if missing else []
+            userids = await user_domains(conn, sorted({userid for userid, _ in domainless})) if domainless else {}
+        for userid, uuid, domainid in rows:
+            found[(userid, uuid)] = domainid if domainid else -1
+            session_cache.set((userid, uuid), found[(userid, uuid)])
+        for session in domainless:
+            home_domains[session] = userids[session[0]]
+            session_cache.set(session, home_domains[session])
+
+    domain_lists = {}
+    if want_domains:
+        domain_lists = await resolve_domains(set(found.values()) | set(home_domains.values()))
+
+    for pos, session in sessions.items():
+        if session in found:
+            domainid = found[session]
+        elif pos in stateless:
+            domainid = home_domains.get(session)
+        else:
+            results[pos].detail = "Authorization Failed"
+            rejected_tokens.set(digests[pos], results[pos].detail)
+            continue
+        lastseen_buffer.touch(*session)
+        results[pos].valid = True
+        if want_domains:
+            results[pos].domains = domain_lists[domainid]
+    return TokenValidationList(results=results)
+
+
+@app.get("/msapi/validateuser")
+async def validateuser(request: Request, domains: Optional[str] = Query(None, pattern="^[y|Y|n|N]$")) -> DomainList:
+    want_domains = domains is not None and domains.lower() == "y"
+
+    token = request.cookies.get("token", None)
+    if token is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authorization Failed")
+
+    try:
+        # Parallel calls from one page load carry the same cookie and share a single validation
+        domainid = await validation_flights.do((token_digest(token), want_domains), db_retry, validate_token, token, want_domains)
+        if not want_domains:
+            return DomainList()
+        with traced_stage("domain_lookup"):
+            body, etag = await db_retry(domain_list_body, domainid)
     except HTTPException:
         raise
     except Exception as err:
-        print(str(err))
+        logging.error("Validation failed: %s", err)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(err)) from None
+
+    # The list is pre-serialized; clients holding the current ETag get a 304 without the body
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.post("/msapi/validateuser/batch")
+async def validateuser_batch(payload: TokenBatch, domains: Optional[str] = Query(None, pattern="^[y|Y|n|N]$")) -> TokenValidationList:
+    want_domains = domains is not None and domains.lower() == "y"
+
+    if len(payload.tokens) > batch_max_tokens:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {batch_max_tokens} tokens can be validated per call")
+
+    try:
+        return await db_retry(validate_tokens, payload.tokens, want_domains)
+    except HTTPException:
+        raise
+    except Exception as err:
+        logging.error("Validation failed: %s", err)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(err)) from None
 
 
@@ -294,20 +2016,70 @@ class ResetPasswordPayload(BaseModel):
     new_password: str
 
 
-def send_email(to: str, subject: str, body: str):
+def email_configured() -> bool:
+    return all([SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SENDER_EMAIL])
+
+
+class SmtpConnection:
+    """
+    Authenticated SMTP session that is kept open between messages.
+    Idle sessions are checked with NOOP before reuse and any failure drops the session so the next send reconnects.
     """
-    Sends an email using SMTP configuration from environment variables.
+
+    def __init__(self):
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        logging.info("Connecting to SMTP server at %s:%s...", SMTP_HOST, SMTP_PORT)
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=smtp_timeout)
+        try:
+            if SMTP_STARTTLS:
+                server.starttls(context=ssl.create_default_context())  # Upgrade the connection to be secure
+                server.login(SMTP_USER, SMTP_PASSWORD)
+            else:
+                # Plain local debugging servers usually do not offer AUTH
+                server.ehlo_or_helo_if_needed()
+                if server.has_extn("auth"):
+                    server.login(SMTP_USER, SMTP_PASSWORD)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+
+    def send(self, msg: EmailMessage):
+        if self._server is not None and time.monotonic() - self._last_used > smtp_idle_timeout:
+            try:
+                self._server.noop()
+            except Exception:
+                self.close()
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.send_message(msg)
+        except Exception:
+            self.close()
+            raise
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                self._server.close()
+            self._server = None
+
+
+def send_email(to: str, subject: str, body: str, connection: SmtpConnection):
+    """
+    Sends an email over the given SMTP connection, raising if the send fails.
     Falls back to printing the email to the console if not configured.
     """
     # Check if all required SMTP environment variables are set
-    if not all([SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SENDER_EMAIL]):
-        logging.warning("Email server not configured. Simulating email sending:")
-        print("-----------------------------------------------------------------")
-        print(f"To: {to}")
-        print(f"Subject: {subject}")
-        print("-----------------------------------------------------------------")
-        print(body)
-        print("-----------------------------------------------------------------")
+    if not email_configured():
+        rule = "-" * 65
+        logging.warning("Email server not configured. Simulating email sending:\n%s\nTo: %s\nSubject: %s\n%s\n%s\n%s", rule, to, subject, rule, body, rule)
         return
 
     # Create the email message
@@ -317,36 +2089,137 @@ def send_email(to: str, subject: str, body: str):
     msg["From"] = SENDER_EMAIL
     msg["To"] = to
 
-    # Create a secure SSL context
-    context = ssl.create_default_context()
+    start = time.perf_counter()
+    result = "error"
+    try:
+        connection.send(msg)
+        result = "sent"
+        logging.info("Email sent successfully to %s", to)
+    finally:
+        EMAIL_SEND_LATENCY.labels(result).observe(time.perf_counter() - start)
+
+
+mail_queue: asyncio.Queue = asyncio.Queue(maxsize=mail_queue_size)
+MAIL_QUEUE_DEPTH.set_function(mail_queue.qsize)
+multiprocess_publisher = MultiprocessPublisher([cache_collector, pool_collector], [REVOKED_SESSIONS, MAIL_QUEUE_DEPTH])
 
+
+def queue_email(to: str, subject: str, body: str) -> bool:
+    """
+    Hands an email to the mail workers without waiting for it to be sent.
+    """
     try:
-        logging.info(f"Connecting to SMTP server at {SMTP_HOST}:{SMTP_PORT} to send email...")
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.starttls(context=context)  # Upgrade the connection to be secure
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.send_message(msg)
-            logging.info(f"Email sent successfully to {to}")
-    except smtplib.SMTPAuthenticationError as e:
-        logging.error(f"SMTP Authentication Error: Failed to send email. Please check credentials. Details: {e}")
-    except smtplib.SMTPConnectError as e:
-        logging.error(f"SMTP Connection Error: Failed to connect to the server. Check SMTP_HOST and SMTP_PORT. Details: {e}")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred while sending email: {e}")
+        mail_queue.put_nowait((to, subject, body))
+        return True
+    except asyncio.QueueFull:
+        MAIL_DROPPED.labels("queue_full").inc()
+        logging.error("Mail queue is full, dropping email to %s", to)
+        return False
+
+
+async def mail_worker():
+    """
+    Background task that sends queued emails over its own persistent SMTP connection,
+    retrying failed sends with exponential backoff.
+    """
+    connection = SmtpConnection()
+    try:
+        while True:
+            to, subject, body = await mail_queue.get()
+            try:
+                for attempt in range(1, mail_retries + 1):
+                    try:
+                        await asyncio.to_thread(send_email, to, subject, body, connection)
+                        break
+                    except smtplib.SMTPAuthenticationError as e:
+                        logging.error("SMTP Authentication Error: Failed to send email. Please check credentials. Details: %s", e)
+                    except smtplib.SMTPConnectError as e:
+                        logging.error("SMTP Connection Error: Failed to connect to the server. Check SMTP_HOST and SMTP_PORT. Details: %s", e)
+                    except Exception as e:
+                        logging.error("An unexpected error occurred while sending email: %s", e)
+                    if attempt < mail_retries:
+                        await asyncio.sleep(random.uniform(0.5, 1.0) * 2 ** (attempt - 1))
+                else:
+                    MAIL_DROPPED.labels("send_failed").inc()
+                    logging.error("Giving up on email to %s after %d attempts", to, mail_retries)
+            finally:
+                mail_queue.task_done()
+    finally:
+        await asyncio.to_thread(connection.close)
 
 
 # ------------------------------------------------------------------------------------
 # Login Help Landing Page
 # ------------------------------------------------------------------------------------
+class RenderedPage:
+    """
+    HTML page rendered once and kept pre-compressed.
+    Served with ETag/Last-Modified validators so repeat visits can be answered with 304.
+    """
+
+    def __init__(self, html: str, cache_control: str):
+        self.body = html.encode("utf-8")
+        self.encoded = {
+            "br": brotli.compress(self.body, quality=11),
+            "gzip": gzip.compress(self.body, compresslevel=9, mtime=0),
+        }
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.modified = int(time.time())
+        self.cache_control = cache_control
+
+    def not_modified(self, request: Request) -> bool:
+        if request.headers.get("if-none-match") is not None:
+            return etag_matches(request, self.etag)
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def response(self, request: Request) -> Response:
+        headers = {
+            "ETag": self.etag,
+            "Last-Modified": formatdate(self.modified, usegmt=True),
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if self.not_modified(request):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        accepted = set()
+        for item in request.headers.get("accept-encoding", "").split(","):
+            name, _, params = item.strip().partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(name.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in accepted:
+                headers["Content-Encoding"] = encoding
+                return HTMLResponse(content=self.encoded[encoding], headers=headers)
+        return HTMLResponse(content=self.body, headers=headers)
+
+
+@cache
+def rendered_login_help_page(mail_enabled: bool) -> RenderedPage:
+    return RenderedPage(render_login_help_page(mail_enabled), f"public, max-age={page_cache_max_age}")
+
+
+def login_help_page() -> RenderedPage:
+    # The page only changes with the email configuration, so it is rendered once per configuration state
+    return rendered_login_help_page(email_configured())
+
+
 @app.get("/loginhelp", response_class=HTMLResponse)
-async def get_login_help_page():
-    # Check if the email server is configured
-    email_configured = all([SMTP_HOST, SMTP_USER, SMTP_PASSWORD, SENDER_EMAIL])
+async def get_login_help_page(request: Request):
+    return login_help_page().response(request)
+
 
+def render_login_help_page(mail_enabled: bool) -> str:
     disabled_attribute = ""
     warning_message_html = ""
 
-    if not email_configured:
+    if not mail_enabled:
         disabled_attribute = "disabled"
         warning_message_html = """
         <div style="padding: 1rem; margin-bottom: 1rem; border: 1px solid #dc3545; border-radius: 5px; background-color: #f8d7da; color: #721c24;">
@@ -537,51 +2410,50 @@ async def get_login_help_page():
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+    return html_content
 
 
 @app.post("/forgot-username", response_model=Message)
-async def forgot_username(payload: ForgotUsernamePayload, background_tasks: BackgroundTasks):
+async def forgot_username(payload: ForgotUsernamePayload, request: Request):
+    check_recovery_rate(request, payload.email)
+
     # Security check: Prevent use if not configured
-    if not all([SMTP_HOST, SMTP_USER, SMTP_PASSWORD, SENDER_EMAIL]):
+    if not email_configured():
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Email service is not configured.")
 
-    with engine.connect() as conn:
+    async with db_connect() as conn:
         sql = text("SELECT name FROM dm.dm_user WHERE email = :email and status = 'N' LIMIT 1")
-        result = conn.execute(sql, {"email": payload.email}).fetchone()
-        if result:
-            username = result[0]
-            background_tasks.add_task(send_email, payload.email, "Your Username", f"Your username is: {username}")
+        result = (await conn.execute(sql, {"email": payload.email})).fetchone()
+    if result:
+        username = result[0]
+        queue_email(payload.email, "Your Username", f"Your username is: {username}")
 
     return {"detail": "If an account with that email exists, your username has been sent."}
 
 
 @app.post("/forgot-password", response_model=Message)
-async def forgot_password(payload: ForgotPasswordPayload, background_tasks: BackgroundTasks, request: Request):
+async def forgot_password(payload: ForgotPasswordPayload, request: Request):
+    check_recovery_rate(request, payload.username)
+
     # Security check: Prevent use if not configured
-    if not all([SMTP_HOST, SMTP_USER, SMTP_PASSWORD, SENDER_EMAIL]):
+    if not email_configured():
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Email service is not configured.")
 
-    with engine.connect() as conn:
+    async with db_connect() as conn:
         sql = text("SELECT email FROM dm.dm_user WHERE name = :username and status = 'N' LIMIT 1")
-        result = conn.execute(sql, {"username": payload.username}).fetchone()
-        if result:
-            email = result[0]
-            token = create_password_reset_token(payload.username)
-
-            # Create a full URL based on the request's host
-            base_url = str(request.base_url)
-            reset_link = f"{base_url}reset-password?token={token}"
-
-            # Create the email body with the expiration notice
-            email_body = f"You have requested to reset your password.\n\nClick this link to proceed:\n{reset_link}\n\nFor your security, this link is only valid for 30 minutes."
-
-            background_tasks.add_task(
-                send_email,
-                email,
-                "Password Reset",
-                email_body,
-            )
+        result = (await conn.execute(sql, {"username": payload.username})).fetchone()
+    if result:
+        email = result[0]
+        token = create_password_reset_token(payload.username)
+
+        # Create a full URL based on the request's host
+        base_url = str(request.base_url)
+        reset_link = f"{base_url}reset-password?token={token}"
+
+        # Create the email body with the expiration notice
+        email_body = f"You have requested to reset your password.\n\nClick this link to proceed:\n{reset_link}\n\nFor your security, this link is only valid for 30 minutes."
+
+        queue_email(email, "Password Reset", email_body)
 
     return {"detail": "If an account with that username exists, a reset link has been sent."}
 
@@ -602,7 +2474,18 @@ def encrypt_password(password: str) -> str:
 # Reset Password Page and Endpoint
 # ------------------------------------------------------------------------------------
 @app.get("/reset-password", response_class=HTMLResponse)
-async def get_reset_password_page(token: str):
+async def get_reset_password_page(token: str, request: Request):
+    # The page itself does not depend on the token; its script reads the token from the URL
+    return reset_password_page().response(request)
+
+
+@cache
+def reset_password_page() -> RenderedPage:
+    # The URL carries a reset token, so keep the page out of shared caches
+    return RenderedPage(render_reset_password_page(), f"private, max-age={page_cache_max_age}")
+
+
+def render_reset_password_page() -> str:
     html_content = """
     <!DOCTYPE html>
     <html>
@@ -778,7 +2661,7 @@ async def get_reset_password_page(token: str):
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+    return html_content
 
 
 @app.post("/reset-password", response_model=Message)
@@ -792,14 +2675,14 @@ async def reset_password(payload: ResetPasswordPayload):
 
     hashed_pw = encrypt_password(payload.new_password)
 
-    with engine.connect() as conn:
-        # Use a transaction to ensure the update is atomic
-        with conn.begin():
-            sql = text("UPDATE dm.dm_user SET passhash = :pw, modified = EXTRACT(EPOCH FROM now())::integer WHERE name = :username")
-            conn.execute(sql, {"pw": hashed_pw, "username": username})
+    # Use a transaction to ensure the update is atomic
+    async with db_connect(begin=True) as conn:
+        sql = text("UPDATE dm.dm_user SET passhash = :pw, modified = EXTRACT(EPOCH FROM now())::integer WHERE name = :username")
+        await conn.execute(sql, {"pw": hashed_pw, "username": username})
 
     return {"detail": "Password has been reset successfully."}
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, port=5000)
+    # Uvicorn's own log config would replace the JSON handlers and re-enable uvicorn.access, duplicating the access log
+    uvicorn.run(app, port=5000, log_config=None, access_log=False)
@@ -0,0 +1,86 @@
+-- Copyright (c) 2021 Linux Foundation
+-- Licensed under the Apache License, Version 2.0
+--
+-- Domain closure table owned by ms-validate-user.
+-- One row per (ancestor, descendant) pair of active domains joined by an active path, including (id, id, 0).
+-- A trigger on dm.dm_domain keeps it current as domains are added, moved, retired or deleted,
+-- and signals the channel passed as its argument so replicas can refresh their in-memory index.
+-- The service installs this script itself; {channel} is replaced with DOMAIN_NOTIFY_CHANNEL.
+-- dm.dm_domain_closure_rebuild() recomputes the whole table if it ever needs repairing.
+
+CREATE TABLE IF NOT EXISTS dm.dm_domain_closure (
+    ancestor integer NOT NULL,
+    descendant integer NOT NULL,
+    depth integer NOT NULL,
+    PRIMARY KEY (ancestor, descendant)
+);
+CREATE INDEX IF NOT EXISTS dm_domain_closure_descendant ON dm.dm_domain_closure (descendant, ancestor);
+
+-- Links every node in child's subtree below every ancestor of parent
+CREATE OR REPLACE FUNCTION dm.dm_domain_closure_attach(child integer, parent integer) RETURNS void AS $$
+    INSERT INTO dm.dm_domain_closure (ancestor, descendant, depth)
+    SELECT a.ancestor, s.descendant, a.depth + s.depth + 1
+    FROM dm.dm_domain_closure a, dm.dm_domain_closure s
+    WHERE a.descendant = parent
+      AND s.ancestor = child
+      AND NOT EXISTS (SELECT 1 FROM dm.dm_domain_closure c WHERE c.ancestor = child AND c.descendant = parent)
+    ON CONFLICT DO NOTHING;
+$$ LANGUAGE sql;
+
+-- Cuts node's subtree off from everything above node
+CREATE OR REPLACE FUNCTION dm.dm_domain_closure_detach(node integer) RETURNS void AS $$
+    DELETE FROM dm.dm_domain_closure c
+    WHERE c.descendant IN (SELECT s.descendant FROM dm.dm_domain_closure s WHERE s.ancestor = node)
+      AND c.ancestor IN (SELECT a.ancestor FROM dm.dm_domain_closure a WHERE a.descendant = node AND a.ancestor <> node);
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION dm.dm_domain_closure_rebuild() RETURNS void AS $$
+    DELETE FROM dm.dm_domain_closure;
+    INSERT INTO dm.dm_domain_closure (ancestor, descendant, depth)
+    WITH RECURSIVE walk (ancestor, descendant, depth) AS (
+        SELECT id, id, 0 FROM dm.dm_domain WHERE status = 'N'
+        UNION ALL
+        SELECT w.ancestor, d.id, w.depth + 1
+        FROM walk w
+            INNER JOIN dm.dm_domain d ON d.domainid = w.descendant AND d.status = 'N'
+        -- Any cycle reachable downwards passes through the starting domain, so this stops corrupt data looping
+        WHERE d.id <> w.ancestor
+    )
+    SELECT ancestor, descendant, depth FROM walk;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION dm.dm_domain_closure_sync() RETURNS trigger AS $$
+DECLARE
+    was_active boolean := TG_OP <> 'INSERT' AND OLD.status = 'N';
+    is_active boolean := TG_OP <> 'DELETE' AND NEW.status = 'N';
+BEGIN
+    IF was_active AND is_active AND NEW.id = OLD.id THEN
+        IF NEW.domainid IS DISTINCT FROM OLD.domainid THEN
+            PERFORM dm.dm_domain_closure_detach(NEW.id);
+            PERFORM dm.dm_domain_closure_attach(NEW.id, NEW.domainid);
+        END IF;
+    ELSE
+        IF was_active THEN
+            -- The children stay linked to their own subtrees and are reattached if the domain comes back
+            PERFORM dm.dm_domain_closure_detach(OLD.id);
+            DELETE FROM dm.dm_domain_closure WHERE ancestor = OLD.id;
+        END IF;
+        IF is_active THEN
+            INSERT INTO dm.dm_domain_closure (ancestor, descendant, depth) VALUES (NEW.id, NEW.id, 0) ON CONFLICT DO NOTHING;
+            PERFORM dm.dm_domain_closure_attach(d.id, NEW.id) FROM dm.dm_domain d WHERE d.domainid = NEW.id AND d.status = 'N';
+            PERFORM dm.dm_domain_closure_attach(NEW.id, NEW.domainid);
+        END IF;
+    END IF;
+    IF TG_ARGV[0] <> '' THEN
+        PERFORM pg_notify(TG_ARGV[0], '');
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS dm_domain_closure_sync ON dm.dm_domain;
+CREATE TRIGGER dm_domain_closure_sync
+    AFTER INSERT OR DELETE OR UPDATE OF id, domainid, status ON dm.dm_domain
+    FOR EACH ROW EXECUTE FUNCTION dm.dm_domain_closure_sync('{channel}');
+
+SELECT dm.dm_domain_closure_rebuild();
@@ -0,0 +1,35 @@
+-- Copyright (c) 2021 Linux Foundation
+-- Licensed under the Apache License, Version 2.0
+--
+-- Revocation log owned by ms-validate-user for stateless validation.
+-- Every session deleted from dm.dm_user_auth, by logout or by the idle session reaper, is recorded here
+-- so replicas can sync the revoked jtis incrementally. The service prunes rows older than REVOCATION_RETENTION.
+-- dm.dm_user_auth_revoked_since holds the time the log started; sessions deleted before then are not in it,
+-- so only tokens issued after it are validated from the log.
+
+CREATE TABLE IF NOT EXISTS dm.dm_user_auth_revoked (
+    jti varchar(2048) NOT NULL,
+    id integer NOT NULL,
+    revoked_at timestamptz NOT NULL DEFAULT clock_timestamp()
+);
+CREATE INDEX IF NOT EXISTS dm_user_auth_revoked_revoked_at ON dm.dm_user_auth_revoked (revoked_at);
+
+CREATE OR REPLACE FUNCTION dm.dm_user_auth_revoke() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO dm.dm_user_auth_revoked (jti, id) SELECT old_rows.jti, old_rows.id FROM old_rows;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS dm_user_auth_revoke ON dm.dm_user_auth;
+CREATE TRIGGER dm_user_auth_revoke
+    AFTER DELETE ON dm.dm_user_auth
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dm.dm_user_auth_revoke();
+
+-- CREATE TRIGGER waits for transactions already deleting sessions, so every deletion after this time is logged
+CREATE TABLE IF NOT EXISTS dm.dm_user_auth_revoked_since (
+    since timestamptz NOT NULL
+);
+INSERT INTO dm.dm_user_auth_revoked_since (since)
+SELECT clock_timestamp() WHERE NOT EXISTS (SELECT 1 FROM dm.dm_user_auth_revoked_since);